@@ -1,80 +1,260 @@
 import asyncio
-import json
+import os
+import time
+from collections import deque
+from contextvars import ContextVar
 from enum import Enum
-from typing import Callable, Dict, Union
+from typing import Callable, Dict, Union, Deque, Set, List, Tuple
+
+from dotenv import load_dotenv
+
+from communication.codecs import Codec, CHANNEL_KEY, DATA_KEY, DIR_KEY, SESSION_KEY, JSON_CODEC, get_codec, \
+    detect_codec
+from communication.metrics import bus_metrics
+
+load_dotenv()
 
 MSG_UPD_INTERVAL = 0.01
+# Maximum amount of messages taken from a bus and not yet handled by listeners
+BUS_DISPATCH_CONCURRENCY = int(os.environ.get('BUS_DISPATCH_CONCURRENCY', 64))
+# Publish batching is enabled by a non zero delay, a batch is sent after the delay or once it is full
+BUS_BATCH_MAX_DELAY_MS = float(os.environ.get('BUS_BATCH_MAX_DELAY_MS', 0))
+BUS_BATCH_MAX_SIZE = int(os.environ.get('BUS_BATCH_MAX_SIZE', 100))
+# Codec used by serializing buses to publish messages, received messages are decoded with any codec
+BUS_CODEC = os.environ.get('BUS_CODEC', JSON_CODEC)
 
-CHANNEL_KEY = 'channel'
-DATA_KEY = 'data'
-DIR_KEY = 'direction'
+# Set for everything running inside a bus worker, i.e. listeners and whatever they publish
+in_bus_worker = ContextVar('in_bus_worker', default=False)
+
+
+_NOT_DECODED = object()
 
 
 class BusDir(Enum):
     TG = 1
     COM = 2
+    # Control events, every process receives all of them
+    CTL = 3
+
+
+def get_dir_channel(channel: str, direction: BusDir) -> str:
+    return f'{direction.value}: {channel}'
+
+
+def get_dir_pattern(direction: BusDir) -> str:
+    return get_dir_channel('*', direction)
+
+
+def get_dir_key(dir_channel: str) -> str:
+    return dir_channel.partition(': ')[0]
+
+
+DIR_LABELS = {str(direction.value): direction.name for direction in BusDir}
+
+
+def get_dir_label(dir_channel: str) -> str:
+    return DIR_LABELS.get(get_dir_key(dir_channel), '')
 
 
 class BusMessage:
-    _channel: str
-    _direction: BusDir
-    _data: any
-    _content: Dict[str, any]
+    __slots__ = ('_channel', '_direction', '_dir_channel', '_published', '_session', '_data', '_payload', '_encoded',
+                 '_codec', 'receipt')
 
-    def __init__(self, encoded_msg: str = '', channel: str = '', direction: BusDir = None, data: any = None):
+    def __init__(self, encoded_msg: Union[str, bytes] = '', channel: str = '', direction: BusDir = None,
+                 data: any = None, dir_channel: str = '', session: Union[str, None] = None):
         if encoded_msg:
-            self._decode_msg(encoded_msg)
+            # Nothing is parsed until it is accessed, a transport may also provide the routing and ordering keys
+            # right away
+            self._encoded = encoded_msg if isinstance(encoded_msg, bytes) else encoded_msg.encode()
+            self._codec = detect_codec(self._encoded)
+            self._channel = None
+            self._direction = None
+            self._dir_channel = dir_channel
+            self._published = 0.0
+            self._session = session
+            self._payload = None
+            self._data = _NOT_DECODED
         elif channel and direction and data:
+            self._encoded = None
+            self._codec = None
             self._channel = channel
             self._direction = direction
+            self._dir_channel = ''
+            self._published = time.time()
+            self._session = (data.get(SESSION_KEY) or '') if isinstance(data, dict) else ''
             self._data = data
         else:
             raise KeyError(f'Either encoded_msg should be provided or channel, direction and data')
-        self._content = {CHANNEL_KEY: self._channel, DIR_KEY: self._direction.value, DATA_KEY: self._data}
+        # Transport specific reference used to acknowledge the message once it is handled
+        self.receipt = None
+
+    def _decode_envelope(self):
+        if self._direction is None:
+            channel, direction, self._published, session, self._payload = self._codec.decode_envelope(self._encoded)
+            self._channel = channel
+            self._direction = BusDir(direction)
+            if self._session is None:
+                self._session = session
 
     @property
     def channel(self):
+        self._decode_envelope()
         return self._channel
 
     @property
     def dir_channel(self):
-        return f'{self._direction.value}: {self._channel}'
+        if not self._dir_channel:
+            self._decode_envelope()
+            self._dir_channel = get_dir_channel(self._channel, self._direction)
+        return self._dir_channel
 
     @property
     def direction(self):
+        self._decode_envelope()
         return self._direction
 
+    @property
+    def published(self) -> float:
+        self._decode_envelope()
+        return self._published
+
+    @property
+    def session(self) -> str:
+        if self._session is None:
+            self._decode_envelope()
+        return self._session
+
     @property
     def data(self):
+        if self._data is _NOT_DECODED:
+            self._decode_envelope()
+            self._data = self._codec.decode_data(self._payload)
+            self._payload = None
         return self._data
 
-    def _decode_msg(self, encoded_msg):
-        message = json.loads(encoded_msg)
-        self._channel = message[CHANNEL_KEY]
-        self._direction = BusDir(message[DIR_KEY])
-        self._data = message[DATA_KEY]
+    def encode(self, codec: Codec) -> bytes:
+        # Received messages are forwarded as they are if the codec did not change
+        if self._encoded is not None and self._codec is codec:
+            return self._encoded
+        return codec.encode(self.channel, self.direction.value, self.published, self.session, self.data)
 
     def __str__(self):
-        return json.dumps(self._content)
+        return self.encode(get_codec(JSON_CODEC)).decode()
 
 
 class BusPrototype:
 
-    def __init__(self, *args, **kwargs):
-        self.channels = []
-        self._listeners = {}
+    def __init__(self, *args, concurrency: int = BUS_DISPATCH_CONCURRENCY,
+                 batch_delay_ms: float = BUS_BATCH_MAX_DELAY_MS, batch_size: int = BUS_BATCH_MAX_SIZE, **kwargs):
+        self.channels: Set[str] = set()
+        self._listeners: Dict[str, Callable[[any], any]] = {}
+        # Listeners of all the channels of a direction, exact channel listeners take precedence
+        self._dir_listeners: Dict[str, Callable[[any], any]] = {}
         self._loop = None
+        self._dispatch_slots = asyncio.Semaphore(concurrency)
+        self._ordered_queues: Dict[str, Deque[BusMessage]] = {}
+        self._batch_delay = batch_delay_ms / 1000
+        self._batch_size = batch_size
+        self._batch: List[Tuple[BusMessage, asyncio.Future]] = []
+        self._batch_timer: Union[asyncio.TimerHandle, None] = None
+        self._batch_lock = asyncio.Lock()
+        self.in_flight = 0
+        # Most messages waited in the local queue at once, for buses which have one
+        self.queue_peak = 0
+        bus_metrics.add_bus(self)
 
     def _get_message(self) -> Union[BusMessage, None]:
         raise NotImplementedError
 
-    async def _worker(self):
+    async def _wait_message(self) -> BusMessage:
+        # Polling fallback for buses which cannot be awaited natively
         while True:
             message = self._get_message()
-            if message and message.dir_channel in self.channels:
-                await self._listeners[message.dir_channel](message)
+            if message:
+                return message
+            await asyncio.sleep(MSG_UPD_INTERVAL)
+
+    @property
+    def queue_depth(self) -> int:
+        return 0
+
+    @staticmethod
+    def _ordering_key(message: BusMessage) -> str:
+        # Messages of one session are delivered in order, different sessions are delivered concurrently
+        if message.session:
+            return f'{message.dir_channel}: {message.session}'
+        return message.dir_channel
+
+    async def _deliver(self, key: str):
+        queue = self._ordered_queues[key]
+        while queue:
+            message = queue.popleft()
+            label = get_dir_label(message.dir_channel)
+            start = time.time()
+            if message.published:
+                bus_metrics.dispatch_wait.observe(label, max(start - message.published, 0.0))
+            try:
+                listener = self._get_listener(message)
+                if listener:
+                    await listener(message)
+                bus_metrics.delivered.inc(label)
+            except Exception as e:
+                bus_metrics.errors.inc(label)
+                print(f'Bus listener of {message.dir_channel} failed: {e!r}')
+            finally:
+                bus_metrics.listener_time.observe(label, time.time() - start)
+                self.in_flight -= 1
+                self._dispatch_slots.release()
+                self._on_handled(message)
+        del self._ordered_queues[key]
+
+    def _dispatch(self, message: BusMessage):
+        key = self._ordering_key(message)
+        if key in self._ordered_queues:
+            self._ordered_queues[key].append(message)
+        else:
+            self._ordered_queues[key] = deque([message])
+            self._loop.create_task(self._deliver(key))
+
+    def _on_handled(self, message: BusMessage):
+        pass
+
+    async def _worker(self):
+        in_bus_worker.set(True)
+        while True:
+            message = await self._wait_message()
+            if self._get_listener(message):
+                await self._dispatch_slots.acquire()
+                self.in_flight += 1
+                self._dispatch(message)
             else:
-                await asyncio.sleep(MSG_UPD_INTERVAL)
+                bus_metrics.dropped.inc(get_dir_label(message.dir_channel))
+                self._on_handled(message)
+
+    def _get_listener(self, message: BusMessage) -> Union[Callable[[any], any], None]:
+        dir_channel = message.dir_channel
+        if dir_channel in self._listeners:
+            return self._listeners[dir_channel]
+        return self._dir_listeners.get(get_dir_key(dir_channel))
+
+    def _add_listener(self, dir_channel: str, listener: Callable[[any], any]) -> bool:
+        is_new = dir_channel not in self.channels
+        self.channels.add(dir_channel)
+        self._listeners[dir_channel] = listener
+        return is_new
+
+    def _remove_listener(self, dir_channel: str) -> bool:
+        if dir_channel not in self.channels:
+            return False
+        self.channels.discard(dir_channel)
+        del self._listeners[dir_channel]
+        return True
+
+    def _is_dir_subscribed(self, dir_channel: str) -> bool:
+        return get_dir_key(dir_channel) in self._dir_listeners
+
+    def _get_dir_channels(self, direction: BusDir) -> List[str]:
+        return [dir_channel for dir_channel in self.channels if get_dir_key(dir_channel) == str(direction.value)]
 
     def _start_thread(self):
         if not self._loop:
@@ -84,8 +264,64 @@ class BusPrototype:
     def publish(self, message: BusMessage) -> bool:
         raise NotImplementedError
 
+    async def _publish_async(self, message: BusMessage) -> bool:
+        return self.publish(message)
+
+    async def _publish_batch(self, messages: List[BusMessage]) -> List[bool]:
+        return [await self._publish_async(message) for message in messages]
+
+    async def _send_batch(self, batch: List[Tuple[BusMessage, asyncio.Future]]):
+        # Batches are sent one after another to keep the order of messages
+        async with self._batch_lock:
+            try:
+                results = await self._publish_batch([message for message, _ in batch])
+            except Exception as e:
+                print(f'Bus batch publish failed: {e!r}')
+                results = [False] * len(batch)
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    def _flush_batch(self):
+        if self._batch_timer:
+            self._batch_timer.cancel()
+            self._batch_timer = None
+        batch, self._batch = self._batch, []
+        if batch:
+            asyncio.get_event_loop().create_task(self._send_batch(batch))
+
+    async def _enqueue_batch(self, message: BusMessage) -> bool:
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self._batch.append((message, future))
+        if len(self._batch) >= self._batch_size:
+            self._flush_batch()
+        elif not self._batch_timer:
+            self._batch_timer = loop.call_later(self._batch_delay, self._flush_batch)
+        return await future
+
+    async def publish_async(self, message: BusMessage) -> bool:
+        if self._batch_delay:
+            result = await self._enqueue_batch(message)
+        else:
+            result = await self._publish_async(message)
+        if result:
+            bus_metrics.published.inc(get_dir_label(message.dir_channel))
+        else:
+            bus_metrics.publish_failed.inc(get_dir_label(message.dir_channel))
+        return result
+
     def subscribe(self, channel: str, direction: BusDir, listener: Callable[[any], any]) -> bool:
         raise NotImplementedError
 
     def unsubscribe(self, channel: str, direction: BusDir) -> bool:
         raise NotImplementedError
+
+    def subscribe_direction(self, direction: BusDir, listener: Callable[[any], any]) -> bool:
+        self._dir_listeners[str(direction.value)] = listener
+        self._start_thread()
+        return True
+
+    def unsubscribe_direction(self, direction: BusDir) -> bool:
+        self._dir_listeners.pop(str(direction.value), None)
+        return True
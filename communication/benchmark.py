@@ -0,0 +1,85 @@
+import asyncio
+import statistics
+import sys
+import time
+from typing import Dict
+
+from communication.base import BusDir, BusMessage
+from communication.manager import Bus, USED_BUS
+
+BENCH_CHANNEL = 'benchmark'
+BENCH_ROUNDS = 1000
+BENCH_BURST = 20000
+INDEX_KEY = 'index'
+
+
+async def measure_round_trips(bus: Bus, rounds: int):
+    # WS -> bus -> bot -> bus -> WS, i.e. two bus hops per round
+    loop = asyncio.get_event_loop()
+    pending: Dict[int, asyncio.Future] = {}
+
+    async def on_com(message: BusMessage):
+        await bus.publish_async(BusMessage(channel=BENCH_CHANNEL, direction=BusDir.TG, data=message.data))
+
+    async def on_tg(message: BusMessage):
+        pending.pop(message.data[INDEX_KEY]).set_result(time.perf_counter())
+
+    bus.subscribe(BENCH_CHANNEL, BusDir.COM, on_com)
+    bus.subscribe(BENCH_CHANNEL, BusDir.TG, on_tg)
+    # Give subscriptions time to settle on external buses
+    await asyncio.sleep(0.5)
+
+    latencies = []
+    for idx in range(rounds):
+        pending[idx] = loop.create_future()
+        start = time.perf_counter()
+        await bus.publish_async(BusMessage(channel=BENCH_CHANNEL, direction=BusDir.COM, data={INDEX_KEY: idx}))
+        latencies.append(await pending[idx] - start)
+
+    bus.unsubscribe(BENCH_CHANNEL, BusDir.COM)
+    bus.unsubscribe(BENCH_CHANNEL, BusDir.TG)
+    return latencies
+
+
+async def measure_throughput(bus: Bus, amount: int):
+    # Many concurrent publishers, like a lot of visitors typing at once
+    received = asyncio.Event()
+    counter = [0]
+
+    async def on_com(_: BusMessage):
+        counter[0] += 1
+        if counter[0] == amount:
+            received.set()
+
+    bus.subscribe(BENCH_CHANNEL, BusDir.COM, on_com)
+    await asyncio.sleep(0.5)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[bus.publish_async(BusMessage(channel=BENCH_CHANNEL, direction=BusDir.COM,
+                                                        data={INDEX_KEY: idx}))
+                           for idx in range(amount)])
+    published = time.perf_counter() - start
+    await received.wait()
+    delivered = time.perf_counter() - start
+
+    bus.unsubscribe(BENCH_CHANNEL, BusDir.COM)
+    return amount / published, amount / delivered
+
+
+def report(latencies):
+    latencies = sorted(latencies)
+    hop = [lat / 2 for lat in latencies]
+    print(f'Bus: {USED_BUS}, rounds: {len(latencies)}')
+    print(f'Round trip, ms: mean={statistics.mean(latencies) * 1e3:.3f} '
+          f'p50={latencies[len(latencies) // 2] * 1e3:.3f} '
+          f'p99={latencies[int(len(latencies) * 0.99)] * 1e3:.3f}')
+    print(f'Single hop, ms: mean={statistics.mean(hop) * 1e3:.3f}')
+
+
+if __name__ == '__main__':
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else BENCH_ROUNDS
+    burst = int(sys.argv[2]) if len(sys.argv) > 2 else BENCH_BURST
+    loop = asyncio.get_event_loop()
+    report(loop.run_until_complete(measure_round_trips(Bus(), rounds)))
+    publish_rate, delivery_rate = loop.run_until_complete(measure_throughput(Bus(), burst))
+    print(f'Burst of {burst}, msg/s: published={publish_rate:.0f} delivered={delivery_rate:.0f}')
@@ -0,0 +1,93 @@
+import json
+import struct
+from typing import Tuple, Union, Dict
+
+CHANNEL_KEY = 'channel'
+DATA_KEY = 'data'
+DIR_KEY = 'direction'
+PUBLISHED_KEY = 'published'
+# Session of a message is a part of the envelope, so messages are ordered without decoding their payloads
+SESSION_KEY = 'session'
+
+JSON_CODEC = 'json'
+BINARY_CODEC = 'binary'
+
+
+class Codec:
+    name: str
+
+    def encode(self, channel: str, direction: int, published: float, session: str, data: any) -> bytes:
+        raise NotImplementedError
+
+    # Returns channel, direction, publish time, session and a payload, which is decoded by `decode_data` only when
+    # needed
+    def decode_envelope(self, encoded_msg: bytes) -> Tuple[str, int, float, str, any]:
+        raise NotImplementedError
+
+    def decode_data(self, payload: any) -> any:
+        raise NotImplementedError
+
+
+class JsonCodec(Codec):
+    name = JSON_CODEC
+
+    def encode(self, channel: str, direction: int, published: float, session: str, data: any) -> bytes:
+        return json.dumps({CHANNEL_KEY: channel, DIR_KEY: direction, PUBLISHED_KEY: published, SESSION_KEY: session,
+                           DATA_KEY: data}).encode()
+
+    def decode_envelope(self, encoded_msg: bytes) -> Tuple[str, int, float, str, any]:
+        message = json.loads(encoded_msg)
+        return message[CHANNEL_KEY], message[DIR_KEY], message.get(PUBLISHED_KEY, 0.0), message.get(SESSION_KEY, ''), \
+            message[DATA_KEY]
+
+    def decode_data(self, payload: any) -> any:
+        return payload
+
+
+class BinaryCodec(Codec):
+    name = BINARY_CODEC
+    # Magic byte, direction, publish time, channel and session lengths followed by the channel, the session and
+    # a compact JSON payload
+    MAGIC = b'\xb2'
+    HEADER = struct.Struct('!cBdHH')
+    # Same without the session, as sent by nodes not updated yet
+    LEGACY_MAGIC = b'\xb1'
+    LEGACY_HEADER = struct.Struct('!cBdH')
+
+    def encode(self, channel: str, direction: int, published: float, session: str, data: any) -> bytes:
+        channel = channel.encode()
+        session = session.encode()
+        payload = json.dumps(data, separators=(',', ':'), ensure_ascii=False).encode()
+        return self.HEADER.pack(self.MAGIC, direction, published, len(channel), len(session)) + channel + session + \
+            payload
+
+    def decode_envelope(self, encoded_msg: bytes) -> Tuple[str, int, float, str, any]:
+        if encoded_msg[:1] == self.LEGACY_MAGIC:
+            _, direction, published, channel_len = self.LEGACY_HEADER.unpack_from(encoded_msg)
+            channel_end = self.LEGACY_HEADER.size + channel_len
+            return encoded_msg[self.LEGACY_HEADER.size:channel_end].decode(), direction, published, '', \
+                encoded_msg[channel_end:]
+        _, direction, published, channel_len, session_len = self.HEADER.unpack_from(encoded_msg)
+        channel_end = self.HEADER.size + channel_len
+        session_end = channel_end + session_len
+        return encoded_msg[self.HEADER.size:channel_end].decode(), direction, published, \
+            encoded_msg[channel_end:session_end].decode(), encoded_msg[session_end:]
+
+    def decode_data(self, payload: any) -> any:
+        return json.loads(payload)
+
+
+CODECS: Dict[str, Codec] = {codec.name: codec for codec in (JsonCodec(), BinaryCodec())}
+
+
+def get_codec(name: str) -> Codec:
+    if name not in CODECS:
+        raise NotImplementedError(f'Codec {name} is not supported')
+    return CODECS[name]
+
+
+def detect_codec(encoded_msg: Union[str, bytes]) -> Codec:
+    # Every codec is understood on receive, so nodes with different BUS_CODEC can share a bus
+    if isinstance(encoded_msg, bytes) and encoded_msg[:1] in (BinaryCodec.MAGIC, BinaryCodec.LEGACY_MAGIC):
+        return CODECS[BINARY_CODEC]
+    return CODECS[JSON_CODEC]
@@ -1,36 +1,79 @@
-from threading import Lock
-from typing import Callable, Union, List
+import asyncio
+import os
+from typing import Callable, Union
 
-from communication.base import BusPrototype, BusDir, BusMessage
+from dotenv import load_dotenv
+
+from communication.base import BusPrototype, BusDir, BusMessage, in_bus_worker, get_dir_channel, get_dir_label
+from communication.metrics import bus_metrics
+
+load_dotenv()
+
+OVERFLOW_BLOCK = 'block'
+OVERFLOW_DROP_OLDEST = 'drop_oldest'
+OVERFLOW_REJECT = 'reject'
+OVERFLOW_POLICIES = [OVERFLOW_BLOCK, OVERFLOW_DROP_OLDEST, OVERFLOW_REJECT]
+
+# Specific buses configurations
+INTERNAL_BUS_SIZE = int(os.environ.get('INTERNAL_BUS_SIZE', 10000))
+INTERNAL_BUS_OVERFLOW = os.environ.get('INTERNAL_BUS_OVERFLOW', OVERFLOW_BLOCK)
+if INTERNAL_BUS_OVERFLOW not in OVERFLOW_POLICIES:
+    raise NotImplementedError(f'Overflow policy {INTERNAL_BUS_OVERFLOW} is not supported')
 
 
 class InternalBus(BusPrototype):
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, size: int = INTERNAL_BUS_SIZE, overflow: str = INTERNAL_BUS_OVERFLOW, **kwargs):
         super().__init__(*args, **kwargs)
-        self._message_bus: List[BusMessage] = []
-        self._lock = Lock()
+        self._message_bus: asyncio.Queue = asyncio.Queue(maxsize=size)
+        self._overflow = overflow
+
+    @property
+    def queue_depth(self) -> int:
+        return self._message_bus.qsize()
 
     def _get_message(self) -> Union[BusMessage, None]:
-        if self._message_bus:
-            with self._lock:
-                return self._message_bus.pop()
-        else:
+        try:
+            return self._message_bus.get_nowait()
+        except asyncio.QueueEmpty:
             return None
 
+    async def _wait_message(self) -> BusMessage:
+        return await self._message_bus.get()
+
+    def _on_put(self):
+        self.queue_peak = max(self.queue_peak, self._message_bus.qsize())
+
     def publish(self, message: BusMessage) -> bool:
-        with self._lock:
-            self._message_bus.append(message)
+        try:
+            self._message_bus.put_nowait(message)
+        except asyncio.QueueFull:
+            if self._overflow != OVERFLOW_DROP_OLDEST:
+                # Synchronous publishers cannot wait, so a blocking bus rejects them as well
+                bus_metrics.dropped.inc(get_dir_label(message.dir_channel))
+                print(f'Internal bus is full ({self._message_bus.maxsize}), message to '
+                      f'{message.dir_channel} is rejected')
+                return False
+            dropped = self._message_bus.get_nowait()
+            self._message_bus.put_nowait(message)
+            bus_metrics.dropped.inc(get_dir_label(dropped.dir_channel))
+            print(f'Internal bus is full ({self._message_bus.maxsize}), the oldest message is dropped')
+        self._on_put()
+        return True
+
+    async def _publish_async(self, message: BusMessage) -> bool:
+        # A listener waiting for space in its own bus would never be woken up again
+        if self._overflow != OVERFLOW_BLOCK or in_bus_worker.get():
+            return self.publish(message)
+        await self._message_bus.put(message)
+        self._on_put()
         return True
 
     def subscribe(self, channel: str, direction: BusDir, listener: Callable[[any], any]) -> bool:
-        if channel not in self.channels:
-            self.channels.append(f'{direction.value}: {channel}')
-            self._listeners[f'{direction.value}: {channel}'] = listener
+        self._add_listener(get_dir_channel(channel, direction), listener)
         self._start_thread()
         return True
 
     def unsubscribe(self, channel: str, direction: BusDir) -> bool:
-        if channel in self.channels:
-            del self._listeners[f'{direction.value}: {channel}']
+        self._remove_listener(get_dir_channel(channel, direction))
         return True
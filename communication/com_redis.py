@@ -4,7 +4,9 @@ from typing import Callable, Union
 import redis
 from dotenv import load_dotenv
 
-from communication.base import BusPrototype, BusDir, BusMessage, DATA_KEY
+from communication.base import BusPrototype, BusDir, BusMessage, DATA_KEY, CHANNEL_KEY, BUS_CODEC, get_dir_channel, \
+    get_dir_pattern
+from communication.codecs import get_codec
 
 load_dotenv()
 
@@ -19,21 +21,18 @@ class RedisBus(BusPrototype):
         super().__init__(*args, **kwargs)
         self._redis = redis.StrictRedis(host=REDIS_HOST, port=REDIS_PORT, db=0)
         self._pubsub = self._redis.pubsub()
+        self._codec = get_codec(BUS_CODEC)
 
     def _get_message(self) -> Union[BusMessage, None]:
-        redis_message = self._pubsub.get_message()
-        if not redis_message or redis_message['type'] == 'subscribe':
+        redis_message = self._pubsub.get_message(ignore_subscribe_messages=True)
+        if not redis_message or redis_message['type'] not in ('message', 'pmessage'):
             return None
-        for key, value in redis_message.items():
-            try:
-                redis_message[key] = value.decode()
-            except (UnicodeDecodeError, AttributeError):
-                pass
-        return BusMessage(redis_message[DATA_KEY])
+        # Redis channel is the routing key, so the message itself is decoded only by a listener
+        return BusMessage(redis_message[DATA_KEY], dir_channel=redis_message[CHANNEL_KEY].decode())
 
     def publish(self, message: BusMessage) -> bool:
         try:
-            self._redis.publish(message.dir_channel, str(message))
+            self._redis.publish(message.dir_channel, message.encode(self._codec))
             return True
         except Exception as e:
             print(e)
@@ -41,10 +40,9 @@ class RedisBus(BusPrototype):
 
     def subscribe(self, channel: str, direction: BusDir, listener: Callable[[any], any]) -> bool:
         try:
-            if channel not in self.channels:
-                self._pubsub.subscribe(f'{direction.value}: {channel}')
-                self.channels.append(f'{direction.value}: {channel}')
-                self._listeners[f'{direction.value}: {channel}'] = listener
+            dir_channel = get_dir_channel(channel, direction)
+            if self._add_listener(dir_channel, listener) and not self._is_dir_subscribed(dir_channel):
+                self._pubsub.subscribe(dir_channel)
             self._start_thread()
             return True
         except Exception as e:
@@ -53,10 +51,33 @@ class RedisBus(BusPrototype):
 
     def unsubscribe(self, channel: str, direction: BusDir) -> bool:
         try:
-            if channel in self.channels:
-                self._pubsub.unsubscribe(f'{direction.value}: {channel}')
-                del self._listeners[f'{direction.value}: {channel}']
+            dir_channel = get_dir_channel(channel, direction)
+            if self._remove_listener(dir_channel) and not self._is_dir_subscribed(dir_channel):
+                self._pubsub.unsubscribe(dir_channel)
             return True
         except Exception as e:
             print(e)
             return False
+
+    def subscribe_direction(self, direction: BusDir, listener: Callable[[any], any]) -> bool:
+        try:
+            self._pubsub.psubscribe(get_dir_pattern(direction))
+            # Exact channels are covered by the pattern, otherwise their messages would come twice
+            dir_channels = self._get_dir_channels(direction)
+            if dir_channels:
+                self._pubsub.unsubscribe(*dir_channels)
+            return super().subscribe_direction(direction, listener)
+        except Exception as e:
+            print(e)
+            return False
+
+    def unsubscribe_direction(self, direction: BusDir) -> bool:
+        try:
+            self._pubsub.punsubscribe(get_dir_pattern(direction))
+            dir_channels = self._get_dir_channels(direction)
+            if dir_channels:
+                self._pubsub.subscribe(*dir_channels)
+            return super().unsubscribe_direction(direction)
+        except Exception as e:
+            print(e)
+            return False
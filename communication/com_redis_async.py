@@ -0,0 +1,162 @@
+import asyncio
+import os
+from typing import Callable, Union, Coroutine, Set, List, Awaitable
+
+from dotenv import load_dotenv
+from redis import asyncio as aioredis
+from redis.exceptions import ConnectionError as RedisConnectionError, TimeoutError as RedisTimeoutError
+
+from communication.base import BusPrototype, BusDir, BusMessage, DATA_KEY, CHANNEL_KEY, BUS_CODEC, get_dir_channel, \
+    get_dir_pattern
+from communication.codecs import get_codec
+
+load_dotenv()
+
+# Specific buses configurations
+REDIS_HOST = os.environ.get('REDIS_HOST')
+REDIS_PORT = int(os.environ.get('REDIS_PORT'))
+# Concurrent publishers wait for a free connection instead of opening one each
+REDIS_MAX_CONNECTIONS = int(os.environ.get('REDIS_MAX_CONNECTIONS', 16))
+
+# Blocking wait for a pubsub message, wakes up earlier as soon as a message arrives
+LISTEN_TIMEOUT = 1.0
+RECONNECT_MIN_DELAY = 0.1
+RECONNECT_MAX_DELAY = 5.0
+PUBLISH_RETRIES = 5
+REDIS_ERRORS = (RedisConnectionError, RedisTimeoutError, OSError)
+
+
+class AsyncRedisBus(BusPrototype):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        pool = aioredis.BlockingConnectionPool(host=REDIS_HOST, port=REDIS_PORT, db=0,
+                                               max_connections=REDIS_MAX_CONNECTIONS)
+        self._redis = aioredis.StrictRedis(connection_pool=pool)
+        self._pubsub: Union[aioredis.client.PubSub, None] = None
+        self._patterns: Set[str] = set()
+        self._has_channels = asyncio.Event()
+        self._codec = get_codec(BUS_CODEC)
+
+    async def _connect(self):
+        self._pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+        if self._patterns:
+            await self._pubsub.psubscribe(*self._patterns)
+        channels = [dir_channel for dir_channel in self.channels if not self._is_dir_subscribed(dir_channel)]
+        if channels:
+            await self._pubsub.subscribe(*channels)
+
+    async def _disconnect(self):
+        pubsub, self._pubsub = self._pubsub, None
+        if pubsub:
+            try:
+                await pubsub.reset()
+            except REDIS_ERRORS:
+                pass
+
+    async def _wait_message(self) -> BusMessage:
+        delay = RECONNECT_MIN_DELAY
+        while True:
+            await self._has_channels.wait()
+            try:
+                if not self._pubsub:
+                    await self._connect()
+                redis_message = await self._pubsub.get_message(ignore_subscribe_messages=True,
+                                                               timeout=LISTEN_TIMEOUT)
+                delay = RECONNECT_MIN_DELAY
+            except REDIS_ERRORS as e:
+                print(f'Redis bus connection lost ({e}), reconnecting in {delay} s')
+                await self._disconnect()
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, RECONNECT_MAX_DELAY)
+                continue
+            if redis_message and redis_message['type'] in ('message', 'pmessage'):
+                return BusMessage(redis_message[DATA_KEY], dir_channel=redis_message[CHANNEL_KEY].decode())
+
+    def _schedule(self, coroutine: Coroutine):
+        async def _run():
+            try:
+                await coroutine
+            except REDIS_ERRORS as e:
+                # The listener reconnects and resubscribes to all the channels on its own
+                print(e)
+
+        asyncio.get_event_loop().create_task(_run())
+
+    def publish(self, message: BusMessage) -> bool:
+        self._schedule(self.publish_async(message))
+        return True
+
+    def _send(self, message: BusMessage, client: Union[aioredis.StrictRedis, aioredis.client.Pipeline]):
+        return client.publish(message.dir_channel, message.encode(self._codec))
+
+    @staticmethod
+    async def _retry(action: Callable[[], Awaitable]) -> bool:
+        delay = RECONNECT_MIN_DELAY
+        for _ in range(PUBLISH_RETRIES):
+            try:
+                await action()
+                return True
+            except REDIS_ERRORS as e:
+                print(f'Redis bus publish failed ({e}), retrying in {delay} s')
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, RECONNECT_MAX_DELAY)
+        return False
+
+    async def _publish_async(self, message: BusMessage) -> bool:
+        return await self._retry(lambda: self._send(message, self._redis))
+
+    async def _publish_batch(self, messages: List[BusMessage]) -> List[bool]:
+        async def _execute():
+            async with self._redis.pipeline(transaction=False) as pipe:
+                for message in messages:
+                    self._send(message, pipe)
+                await pipe.execute()
+
+        return [await self._retry(_execute)] * len(messages)
+
+    def _update_has_channels(self):
+        if self.channels or self._patterns:
+            self._has_channels.set()
+        else:
+            self._has_channels.clear()
+
+    def subscribe(self, channel: str, direction: BusDir, listener: Callable[[any], any]) -> bool:
+        dir_channel = get_dir_channel(channel, direction)
+        if self._add_listener(dir_channel, listener) and self._pubsub and not self._is_dir_subscribed(dir_channel):
+            self._schedule(self._pubsub.subscribe(dir_channel))
+        self._update_has_channels()
+        self._start_thread()
+        return True
+
+    def unsubscribe(self, channel: str, direction: BusDir) -> bool:
+        dir_channel = get_dir_channel(channel, direction)
+        if self._remove_listener(dir_channel) and self._pubsub and not self._is_dir_subscribed(dir_channel):
+            self._schedule(self._pubsub.unsubscribe(dir_channel))
+        self._update_has_channels()
+        return True
+
+    def subscribe_direction(self, direction: BusDir, listener: Callable[[any], any]) -> bool:
+        pattern = get_dir_pattern(direction)
+        if pattern not in self._patterns:
+            self._patterns.add(pattern)
+            if self._pubsub:
+                # Exact channels are covered by the pattern, otherwise their messages would come twice
+                self._schedule(self._pubsub.psubscribe(pattern))
+                dir_channels = self._get_dir_channels(direction)
+                if dir_channels:
+                    self._schedule(self._pubsub.unsubscribe(*dir_channels))
+        self._update_has_channels()
+        return super().subscribe_direction(direction, listener)
+
+    def unsubscribe_direction(self, direction: BusDir) -> bool:
+        pattern = get_dir_pattern(direction)
+        if pattern in self._patterns:
+            self._patterns.discard(pattern)
+            if self._pubsub:
+                self._schedule(self._pubsub.punsubscribe(pattern))
+                dir_channels = self._get_dir_channels(direction)
+                if dir_channels:
+                    self._schedule(self._pubsub.subscribe(*dir_channels))
+        self._update_has_channels()
+        return super().unsubscribe_direction(direction)
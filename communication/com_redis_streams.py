@@ -0,0 +1,228 @@
+import asyncio
+import os
+import socket
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, List, Set, Tuple, Union
+
+from dotenv import load_dotenv
+from redis import asyncio as aioredis
+from redis.exceptions import ResponseError
+
+from communication.base import BusDir, BusMessage
+from communication.com_redis_async import AsyncRedisBus, REDIS_ERRORS, RECONNECT_MIN_DELAY, RECONNECT_MAX_DELAY
+
+load_dotenv()
+
+# Specific buses configurations
+REDIS_STREAM_PREFIX = os.environ.get('REDIS_STREAM_PREFIX', 'tgchat:bus')
+# Consumers within one group share the messages, each group receives all of them, see NODE_DIRS and BROADCAST_DIRS
+REDIS_STREAM_GROUP = os.environ.get('REDIS_STREAM_GROUP', 'tgchat')
+# Stable name of this node, a restarted node resumes reading its own group where it stopped
+REDIS_STREAM_NODE = os.environ.get('REDIS_STREAM_NODE', socket.gethostname())
+REDIS_STREAM_CONSUMER = os.environ.get('REDIS_STREAM_CONSUMER', f'{socket.gethostname()}-{os.getpid()}')
+REDIS_STREAM_MAXLEN = int(os.environ.get('REDIS_STREAM_MAXLEN', 100000))
+# Messages not acknowledged for this long by another consumer are taken over
+REDIS_STREAM_RECLAIM_IDLE_MS = int(os.environ.get('REDIS_STREAM_RECLAIM_IDLE_MS', 60000))
+RECLAIM_INTERVAL = 10.0
+READ_COUNT = 100
+READ_BLOCK_MS = 1000
+READ_NEW = '>'
+READ_PENDING = '0'
+READ_START = '0-0'
+
+# Every node reads these streams in full within a group of its own. Replies to visitors are among them, as only the
+# WS node holding a visitor socket can deliver the reply, and the group keeps the ones sent while the node restarts
+NODE_DIRS = (BusDir.TG,)
+# Every consumer reads these streams in full from the moment it subscribes, control events only update caches which
+# are loaded anew on start anyway
+BROADCAST_DIRS = (BusDir.CTL,)
+
+BROADCAST_READER = ''
+
+CHANNEL_FIELD = b'c'
+SESSION_FIELD = b's'
+MESSAGE_FIELD = b'm'
+
+
+class RedisStreamBus(AsyncRedisBus):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._fetched: Deque[BusMessage] = deque()
+        # Group to its stream keys and the ids to read them from, None until the group is ensured
+        self._groups: Dict[str, Dict[str, any]] = {}
+        # Broadcast stream key to the last read id, None until the last id of the stream is known
+        self._broadcasts: Dict[str, any] = {}
+        self._last_reclaims: Dict[str, float] = {}
+        # Receipts of entries fetched and not yet acknowledged by this consumer
+        self._held: Set[Tuple[str, str, bytes]] = set()
+        # Group or BROADCAST_READER to the task reading its streams
+        self._readers: Dict[str, asyncio.Task] = {}
+        self._reading = False
+        self._has_fetched = asyncio.Event()
+        self._drained = asyncio.Event()
+
+    @property
+    def queue_depth(self) -> int:
+        # Entries read from Redis and not yet taken for dispatching
+        return len(self._fetched)
+
+    @staticmethod
+    def _stream_key(direction: BusDir) -> str:
+        return f'{REDIS_STREAM_PREFIX}:{direction.value}'
+
+    @staticmethod
+    def _stream_group(direction: BusDir) -> str:
+        return f'{REDIS_STREAM_GROUP}:{REDIS_STREAM_NODE}' if direction in NODE_DIRS else REDIS_STREAM_GROUP
+
+    def _send(self, message: BusMessage, client: Union[aioredis.StrictRedis, aioredis.client.Pipeline]):
+        return client.xadd(self._stream_key(message.direction),
+                           {CHANNEL_FIELD: message.dir_channel, SESSION_FIELD: message.session,
+                            MESSAGE_FIELD: message.encode(self._codec)},
+                           maxlen=REDIS_STREAM_MAXLEN, approximate=True)
+
+    async def _ensure_group(self, group: str):
+        streams = self._groups[group]
+        for stream, read_id in list(streams.items()):
+            if read_id is not None:
+                continue
+            try:
+                # Created at the last id known to Redis, so the clocks of the nodes do not matter
+                await self._redis.xgroup_create(stream, group, id='$', mkstream=True)
+            except ResponseError as e:
+                if 'BUSYGROUP' not in str(e):
+                    raise
+            # Entries left unacknowledged by a previous run of this consumer go first
+            streams[stream] = READ_PENDING
+
+    def _add_entries(self, stream: str, entries: List[Tuple[bytes, Dict[bytes, bytes]]], group: str = ''):
+        # Entries of broadcast streams have no group
+        for entry_id, fields in entries:
+            if entry_id is None:
+                # Redis 6.2 reclaims entries trimmed from the stream without their ids, so they cannot be acknowledged
+                continue
+            if group and (stream, group, entry_id) in self._held:
+                # Own entries still waiting or being handled are reclaimed too once they are idle for long enough
+                continue
+            if not fields:
+                # Entry was trimmed from the stream while pending
+                self._schedule(self._redis.xack(stream, group, entry_id))
+                continue
+            session = fields[SESSION_FIELD].decode() if SESSION_FIELD in fields else None
+            message = BusMessage(fields[MESSAGE_FIELD], dir_channel=fields[CHANNEL_FIELD].decode(), session=session)
+            if group:
+                message.receipt = (stream, group, entry_id)
+                self._held.add(message.receipt)
+            self._fetched.append(message)
+
+    async def _fetch_broadcasts(self):
+        for stream, read_id in list(self._broadcasts.items()):
+            if read_id is None:
+                # Only entries added after the last one in Redis are read
+                last = await self._redis.xrevrange(stream, count=1)
+                self._broadcasts[stream] = last[0][0] if last else READ_START
+        response = await self._redis.xread(self._broadcasts, count=READ_COUNT, block=READ_BLOCK_MS)
+        for stream, entries in response or []:
+            stream = stream.decode()
+            self._broadcasts[stream] = entries[-1][0]
+            self._add_entries(stream, entries)
+
+    async def _reclaim(self, group: str):
+        self._last_reclaims[group] = time.monotonic()
+        for stream in list(self._groups[group]):
+            held = set(self._held)
+            entries = await self._redis.xautoclaim(stream, group, REDIS_STREAM_CONSUMER,
+                                                   REDIS_STREAM_RECLAIM_IDLE_MS, count=READ_COUNT)
+            # Entries acknowledged while being claimed are not taken again either
+            self._add_entries(stream, [entry for entry in entries if (stream, group, entry[0]) not in held], group)
+
+    async def _fetch_group(self, group: str):
+        await self._ensure_group(group)
+        if time.monotonic() - self._last_reclaims.get(group, 0.0) > RECLAIM_INTERVAL:
+            await self._reclaim(group)
+            if self._fetched:
+                return
+        streams = self._groups[group]
+        response = await self._redis.xreadgroup(group, REDIS_STREAM_CONSUMER, streams,
+                                                count=READ_COUNT, block=READ_BLOCK_MS)
+        for stream, entries in response or []:
+            stream = stream.decode()
+            if streams[stream] != READ_NEW:
+                # Own pending entries are paged through once, then only new ones are read
+                streams[stream] = entries[-1][0] if entries else READ_NEW
+            self._add_entries(stream, entries, group)
+
+    async def _read(self, group: str):
+        delay = RECONNECT_MIN_DELAY
+        while True:
+            await self._has_channels.wait()
+            # Next entries are read once the fetched ones are taken
+            await self._drained.wait()
+            try:
+                if group == BROADCAST_READER:
+                    await self._fetch_broadcasts()
+                else:
+                    await self._fetch_group(group)
+                delay = RECONNECT_MIN_DELAY
+            except ResponseError as e:
+                if 'NOGROUP' in str(e):
+                    # Redis lost its data, consumer groups are created again
+                    self._groups[group] = dict.fromkeys(self._groups[group])
+                    continue
+                # Nothing awaits the reader, so it keeps going once Redis recovers, e.g. from OOM
+                print(f'Redis stream bus read failed ({e}), retrying in {delay} s')
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, RECONNECT_MAX_DELAY)
+            except REDIS_ERRORS as e:
+                print(f'Redis stream bus connection lost ({e}), reconnecting in {delay} s')
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, RECONNECT_MAX_DELAY)
+            if self._fetched:
+                self._drained.clear()
+                self._has_fetched.set()
+
+    def _start_readers(self):
+        # Each group and the broadcasts are read at once, so a blocking read of one does not delay the others
+        readers = list(self._groups) + ([BROADCAST_READER] if self._broadcasts else [])
+        for reader in readers:
+            if reader not in self._readers:
+                self._readers[reader] = asyncio.get_event_loop().create_task(self._read(reader))
+
+    async def _wait_message(self) -> BusMessage:
+        if not self._reading:
+            self._reading = True
+            self._start_readers()
+        while not self._fetched:
+            self._has_fetched.clear()
+            self._drained.set()
+            await self._has_fetched.wait()
+        return self._fetched.popleft()
+
+    async def _ack(self, receipt: Tuple[str, str, bytes]):
+        stream, group, entry_id = receipt
+        try:
+            await self._redis.xack(stream, group, entry_id)
+        finally:
+            # Released only once acknowledged, otherwise a reclaim in between would take the entry again
+            self._held.discard(receipt)
+
+    def _on_handled(self, message: BusMessage):
+        if message.receipt:
+            self._schedule(self._ack(message.receipt))
+
+    def _add_stream(self, direction: BusDir):
+        if direction in BROADCAST_DIRS:
+            self._broadcasts.setdefault(self._stream_key(direction), None)
+        else:
+            self._groups.setdefault(self._stream_group(direction), {}).setdefault(self._stream_key(direction), None)
+        if self._reading:
+            self._start_readers()
+
+    def subscribe(self, channel: str, direction: BusDir, listener: Callable[[any], any]) -> bool:
+        self._add_stream(direction)
+        return super().subscribe(channel, direction, listener)
+
+    def subscribe_direction(self, direction: BusDir, listener: Callable[[any], any]) -> bool:
+        self._add_stream(direction)
+        return super().subscribe_direction(direction, listener)
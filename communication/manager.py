@@ -9,8 +9,10 @@ from communication.base import BusPrototype
 load_dotenv()
 
 REDIS_BUS = 'redis'
+REDIS_ASYNC_BUS = 'redis_async'
+REDIS_STREAM_BUS = 'redis_streams'
 INTERNAL_BUS = 'internal'
-BUS_LIST = [REDIS_BUS, INTERNAL_BUS]
+BUS_LIST = [REDIS_BUS, REDIS_ASYNC_BUS, REDIS_STREAM_BUS, INTERNAL_BUS]
 
 USED_BUS = os.environ.get('USED_BUS')
 if USED_BUS not in BUS_LIST:
@@ -18,6 +20,10 @@ if USED_BUS not in BUS_LIST:
 
 if USED_BUS == REDIS_BUS:
     from communication.com_redis import RedisBus
+if USED_BUS == REDIS_ASYNC_BUS:
+    from communication.com_redis_async import AsyncRedisBus
+if USED_BUS == REDIS_STREAM_BUS:
+    from communication.com_redis_streams import RedisStreamBus
 if USED_BUS == INTERNAL_BUS:
     from communication.com_internal import InternalBus
 
@@ -55,6 +61,18 @@ if USED_BUS == REDIS_BUS:
             return super().__new__(cls, bus_class=RedisBus)
 
 
+if USED_BUS == REDIS_ASYNC_BUS:
+    class AsyncRedisBusFactory(BusFactory, Bus, ABC, prefix=REDIS_ASYNC_BUS):
+        def __new__(cls, *args, **kwargs):
+            return super().__new__(cls, bus_class=AsyncRedisBus)
+
+
+if USED_BUS == REDIS_STREAM_BUS:
+    class RedisStreamBusFactory(BusFactory, Bus, ABC, prefix=REDIS_STREAM_BUS):
+        def __new__(cls, *args, **kwargs):
+            return super().__new__(cls, bus_class=RedisStreamBus)
+
+
 if __name__ == '__main__':
     def test_listener(message: any):
         print(message)
@@ -0,0 +1,136 @@
+import asyncio
+import os
+import weakref
+from bisect import bisect_left
+from collections import defaultdict
+from typing import Callable, Dict, List, Tuple
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Metrics are served only if the port is set, on localhost by default
+METRICS_HOST = os.environ.get('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 0))
+METRICS_PATH = '/metrics'
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _labels(direction: str, le: str = '') -> str:
+    labels = [f'direction="{direction}"'] if direction else []
+    if le:
+        labels.append(f'le="{le}"')
+    return f'{{{",".join(labels)}}}' if labels else ''
+
+
+class Counter:
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self.values: Dict[str, float] = defaultdict(float)
+
+    def inc(self, direction: str, amount: float = 1):
+        self.values[direction] += amount
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} counter']
+        lines += [f'{self.name}{_labels(direction)} {value}' for direction, value in self.values.items()]
+        return lines
+
+
+class Gauge:
+    def __init__(self, name: str, description: str, collect: Callable[[], float]):
+        self.name = name
+        self.description = description
+        self.collect = collect
+
+    def render(self) -> List[str]:
+        return [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} gauge',
+                f'{self.name} {self.collect()}']
+
+
+class Histogram:
+    def __init__(self, name: str, description: str, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        # The last bucket counts observations above the highest bound
+        self.counts: Dict[str, List[int]] = defaultdict(lambda: [0] * (len(self.buckets) + 1))
+        self.sums: Dict[str, float] = defaultdict(float)
+
+    def observe(self, direction: str, value: float):
+        self.counts[direction][bisect_left(self.buckets, value)] += 1
+        self.sums[direction] += value
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} histogram']
+        for direction, counts in self.counts.items():
+            total = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                total += count
+                lines.append(f'{self.name}_bucket{_labels(direction, str(bound))} {total}')
+            lines.append(f'{self.name}_sum{_labels(direction)} {self.sums[direction]}')
+            lines.append(f'{self.name}_count{_labels(direction)} {total}')
+        return lines
+
+
+class BusMetrics:
+    def __init__(self):
+        self._buses = weakref.WeakSet()
+        self.published = Counter('bus_messages_published_total', 'Messages published to the bus')
+        self.publish_failed = Counter('bus_messages_publish_failed_total', 'Messages the bus failed to publish')
+        self.dropped = Counter('bus_messages_dropped_total', 'Messages dropped by a full bus or without a listener')
+        self.delivered = Counter('bus_messages_delivered_total', 'Messages handled by listeners')
+        self.errors = Counter('bus_listener_errors_total', 'Listeners which raised an exception')
+        self.dispatch_wait = Histogram('bus_dispatch_wait_seconds', 'Time from publishing to a listener start')
+        self.listener_time = Histogram('bus_listener_seconds', 'Time from a listener start to its end')
+        self.queue_depth = Gauge('bus_queue_depth', 'Messages waiting in local bus queues',
+                                 lambda: sum(bus.queue_depth for bus in self._buses))
+        self.queue_peak = Gauge('bus_queue_peak', 'Most messages waiting in a local bus queue at once',
+                                lambda: max((bus.queue_peak for bus in self._buses), default=0))
+        self.in_flight = Gauge('bus_dispatch_in_flight', 'Messages taken from buses and not handled yet',
+                               lambda: sum(bus.in_flight for bus in self._buses))
+
+    def add_bus(self, bus):
+        self._buses.add(bus)
+
+    def render(self) -> str:
+        lines = []
+        for metric in (self.published, self.publish_failed, self.dropped, self.delivered, self.errors,
+                       self.dispatch_wait, self.listener_time, self.queue_depth, self.queue_peak, self.in_flight):
+            lines += metric.render()
+        return '\n'.join(lines) + '\n'
+
+
+bus_metrics = BusMetrics()
+_metrics_server_started = False
+
+
+async def _handle_request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+            pass
+        parts = request_line.decode(errors='replace').split()
+        if len(parts) > 1 and parts[1].split('?')[0] == METRICS_PATH:
+            status, body = '200 OK', bus_metrics.render().encode()
+        else:
+            status, body = '404 Not Found', b'Not found\n'
+        writer.write(f'HTTP/1.1 {status}\r\nContent-Type: {CONTENT_TYPE}\r\n'
+                     f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body)
+        await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+def serve_metrics(host: str = METRICS_HOST, port: int = METRICS_PORT):
+    # Both the bot and WS server may run in one process, the endpoint is started once
+    global _metrics_server_started
+    if not port or _metrics_server_started:
+        return
+    _metrics_server_started = True
+    asyncio.get_event_loop().create_task(asyncio.start_server(_handle_request, host, port))
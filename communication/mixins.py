@@ -1,68 +1,85 @@
+import asyncio
 from abc import abstractmethod
-from typing import Dict
+from collections import defaultdict
+from typing import Dict, List, Callable, Awaitable
 
-from communication.base import BusMessage
+from communication.base import BusMessage, BusDir
 from communication.manager import Bus
-from db.website import get_website_hosts, TOKEN_KEY, HOST_KEY, get_website_tokens_hosts
+from communication.metrics import serve_metrics
+from db.website import TOKEN_KEY, HOST_KEY, SESSION_KEY, BANNED_KEY, get_host_from_token, invalidate_website, \
+    add_invalidation_listener, add_ban_listener, load_websites_cache
 from helpers.parsing import extract_host
 
+WEBSITE_EVENT = 'website'
+BAN_EVENT = 'ban'
+
+# Control events are received once per process, whatever amount of mixins share its bus
+_event_handlers: Dict[str, List[Callable[[any], Awaitable]]] = defaultdict(list)
+_events_subscribed = False
+
+
+def add_bus_event_handler(event: str, handler: Callable[[any], Awaitable]):
+    _event_handlers[event].append(handler)
+
+
+async def _on_bus_event(message: BusMessage):
+    for handler in _event_handlers.get(message.channel, []):
+        await handler(message.data)
+
+
+async def _on_website_event(data: dict):
+    await invalidate_website(data[TOKEN_KEY], data[HOST_KEY], notify=False)
+
 
 class BusMixin:
     def __init__(self, *args, sub_dir, pub_dir, **kwargs):
         super().__init__(*args, **kwargs)
         self._bus: Bus = Bus()
-        self._bus_websites: Dict[str, str] = {}
         self._sub_dir = sub_dir
         self._pub_dir = pub_dir
-        self._subscribe_to_all_buses()
-
-    def _subscribe_to_all_buses(self):
-        websites = get_website_hosts()
-
-        for website in websites:
-            token = website[TOKEN_KEY]
-            host = website[HOST_KEY]
-            self._subscribe_bus(host, token)
-
-    def _subscribe_bus(self, host: str, token: str):
-        self._bus_websites[token] = host
-        self._bus.subscribe(token, self._sub_dir, lambda msg: self._on_bus_message(msg))
+        # One subscription serves all the websites, so adding a website costs nothing at the bus layer
+        self._bus.subscribe_direction(self._sub_dir, self._on_bus_message)
+        self._subscribe_events()
+        serve_metrics()
 
-    def _unsubscribe_bus(self, token: str):
-        del self._bus_websites[token]
-        self._bus.unsubscribe(token, self._sub_dir)
+    def _subscribe_events(self):
+        global _events_subscribed
+        if _events_subscribed:
+            return
+        _events_subscribed = True
+        add_bus_event_handler(WEBSITE_EVENT, _on_website_event)
+        add_invalidation_listener(self._send_website_event)
+        add_ban_listener(self._send_ban_event)
+        self._bus.subscribe_direction(BusDir.CTL, _on_bus_event)
+        asyncio.get_event_loop().create_task(load_websites_cache())
 
     async def _on_bus_message(self, message: BusMessage):
-        # if self.verify_bus_sender(message[DATA_KEY][HOST_KEY], message[CHANNEL_KEY]):
-        #     # TODO: send an error message?
-        #     return await self.on_bus_message(message)
+        if not await get_host_from_token(message.channel):
+            print(f'Bus message for an unknown website ({message.channel}) is dropped')
+            return
         return await self.on_bus_message(message)
 
-    def _update_websites(self):
-        tokens_hosts = get_website_tokens_hosts()
-        db_tokens = [th[TOKEN_KEY] for th in tokens_hosts]
-        for bus_token in self._bus_websites:
-            if bus_token not in db_tokens:
-                self._unsubscribe_bus(bus_token)
-        for token_host in tokens_hosts:
-            if token_host[TOKEN_KEY] not in self._bus_websites:
-                self._subscribe_bus(token_host[HOST_KEY], token_host[TOKEN_KEY])
-
-    def verify_bus_sender(self, host: str, token: str):
-        if token not in self._bus_websites:
-            self._update_websites()
+    async def verify_bus_sender(self, host: str, token: str):
         # Clean host string from http, www, etc.
         host = extract_host(host)
-        if token in self._bus_websites and self._bus_websites[token] == host:
+        if host and await get_host_from_token(token) == host:
             return True
-        print(f'Token ({token}) and/or host ({host}) are incorrect! Websites = {self._bus_websites}')
+        print(f'Token ({token}) and/or host ({host}) are incorrect!')
         return False
 
     @abstractmethod
     async def on_bus_message(self, message: BusMessage):
-        if message.data[TOKEN_KEY] not in self._bus_websites:
-            self._update_websites()
+        pass
 
-    def send_bus_message(self, token: str, data: any):
+    async def send_bus_message(self, token: str, data: any):
         message = BusMessage(channel=token, direction=self._pub_dir, data=data)
-        return self._bus.publish(message)
+        return await self._bus.publish_async(message)
+
+    async def send_bus_event(self, event: str, data: dict):
+        return await self._bus.publish_async(BusMessage(channel=event, direction=BusDir.CTL, data=data))
+
+    async def _send_website_event(self, token: str, host: str):
+        await self.send_bus_event(WEBSITE_EVENT, {TOKEN_KEY: token, HOST_KEY: host})
+
+    async def _send_ban_event(self, token: str, session: str, banned: bool):
+        await self.send_bus_event(BAN_EVENT, {TOKEN_KEY: token, SESSION_KEY: session, BANNED_KEY: banned})
@@ -0,0 +1,118 @@
+import asyncio
+import gzip
+import json
+import os
+import time
+from datetime import datetime, timedelta
+from typing import List
+
+import pymongo
+from pymongo.errors import BulkWriteError
+
+from db.base import ARCHIVE_DIR, ARCHIVE_INTERVAL, RESTORE_DAYS
+from db.messaging import ID_KEY, EXPIRE_AT_KEY, RESTORED_KEY, DUPLICATE_KEY_ERROR, get_messages_col, apply_retention
+from db.website import TOKEN_KEY, SESSION_KEY, RETENTION_KEY, get_websites_col, set_website_retention
+from helpers.ids import id_from_timestamp
+
+ARCHIVE_SUFFIX = '.jsonl.gz'
+ARCHIVE_BATCH_SIZE = 1000
+DAY_SECONDS = 24 * 60 * 60
+
+
+def get_archive_path(token: str, session: str) -> str:
+    return os.path.join(ARCHIVE_DIR, token, f'{session}{ARCHIVE_SUFFIX}')
+
+
+def _append_lines(path: str, lines: List[str]):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Every append is a gzip member of its own, which are read back as one stream
+    with gzip.open(path, 'at', encoding='utf-8') as archive:
+        archive.writelines(lines)
+
+
+def _read_messages(path: str) -> List[dict]:
+    if not os.path.exists(path):
+        return []
+    with gzip.open(path, 'rt', encoding='utf-8') as archive:
+        return [json.loads(line) for line in archive if line.strip()]
+
+
+async def archive_session(token: str, session: str, before_id: int) -> int:
+    # Messages are deleted only once all of them are in the file, an interrupted run leaves duplicates at most
+    loop = asyncio.get_event_loop()
+    messages = await get_messages_col()
+    path = get_archive_path(token, session)
+    query = {TOKEN_KEY: token, SESSION_KEY: session, ID_KEY: {'$lt': before_id}, RESTORED_KEY: {'$exists': False}}
+    lines, archived, last_id = [], 0, None
+    async for message in messages.find(query, {'_id': 0, EXPIRE_AT_KEY: 0}).sort(ID_KEY, pymongo.ASCENDING):
+        lines.append(json.dumps(message, ensure_ascii=False) + '\n')
+        last_id = message[ID_KEY]
+        if len(lines) >= ARCHIVE_BATCH_SIZE:
+            await loop.run_in_executor(None, _append_lines, path, lines)
+            archived += len(lines)
+            lines = []
+    if lines:
+        await loop.run_in_executor(None, _append_lines, path, lines)
+        archived += len(lines)
+    if last_id is not None:
+        query[ID_KEY] = {'$lte': last_id}
+        await messages.delete_many(query)
+    return archived
+
+
+async def archive_expired() -> int:
+    websites = await get_websites_col()
+    messages = await get_messages_col()
+    archived = 0
+    async for website in websites.find({RETENTION_KEY: {'$gt': 0}}, {TOKEN_KEY: 1, RETENTION_KEY: 1}):
+        token = website[TOKEN_KEY]
+        before_id = id_from_timestamp(time.time() - website[RETENTION_KEY] * DAY_SECONDS)
+        query = {TOKEN_KEY: token, ID_KEY: {'$lt': before_id}, RESTORED_KEY: {'$exists': False}}
+        async for session in messages.aggregate([{'$match': query}, {'$group': {'_id': f'${SESSION_KEY}'}}]):
+            archived += await archive_session(token, session['_id'], before_id)
+    return archived
+
+
+async def restore_session(token: str, session: str) -> int:
+    # Archive stays as it is, restored messages are kept for RESTORE_DAYS only
+    loop = asyncio.get_event_loop()
+    archived = await loop.run_in_executor(None, _read_messages, get_archive_path(token, session))
+    if not archived:
+        return 0
+    messages = await get_messages_col()
+    expire_at = datetime.utcnow() + timedelta(days=RESTORE_DAYS)
+    restored = len(archived)
+    for idx in range(0, len(archived), ARCHIVE_BATCH_SIZE):
+        batch = [{**message, RESTORED_KEY: True, EXPIRE_AT_KEY: expire_at}
+                 for message in archived[idx:idx + ARCHIVE_BATCH_SIZE]]
+        try:
+            await messages.insert_many(batch, ordered=False)
+        except BulkWriteError as e:
+            # Messages which are still stored are not duplicated
+            errors = e.details['writeErrors']
+            if any(error['code'] != DUPLICATE_KEY_ERROR for error in errors):
+                raise
+            restored -= len(errors)
+    return restored
+
+
+async def set_retention(username: str, token: str, days: float) -> bool:
+    if not await set_website_retention(username, token, days):
+        return False
+    await apply_retention(token, days)
+    return True
+
+
+async def run_archiving(interval: float = ARCHIVE_INTERVAL):
+    while True:
+        try:
+            archived = await archive_expired()
+            if archived:
+                print(f'Archived {archived} expired messages')
+        except Exception as e:
+            print(f'Archiving failed: {e!r}')
+        await asyncio.sleep(interval)
+
+
+if __name__ == '__main__':
+    print(f'Archived {asyncio.get_event_loop().run_until_complete(archive_expired())} expired messages')
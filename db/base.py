@@ -1,13 +1,44 @@
+import asyncio
+import hashlib
 import os
-import pymongo
+from concurrent.futures import ProcessPoolExecutor
+
+from motor.motor_asyncio import AsyncIOMotorClient
 from passlib.context import CryptContext
 
 from dotenv import load_dotenv
 
+from helpers.cache import TTLCache
+
 load_dotenv()
 
 MONGODB_HOST = os.environ.get('MONGODB_HOST')
 MONGODB_PORT = int(os.environ.get('MONGODB_PORT'))
+MONGODB_POOL_SIZE = int(os.environ.get('MONGODB_POOL_SIZE', 100))
+# Messages are written right away, ones coming during a write are batched and written once it is done, once a batch
+# is full or once its oldest message waited long enough
+MESSAGE_WRITE_BATCH_SIZE = int(os.environ.get('MESSAGE_WRITE_BATCH_SIZE', 500))
+MESSAGE_WRITE_MAX_DELAY_MS = float(os.environ.get('MESSAGE_WRITE_MAX_DELAY_MS', 50))
+# 'ack' forwards a message once it is stored, 'forward' does not wait for the database
+MESSAGE_DURABILITY_ACK = 'ack'
+MESSAGE_DURABILITY_FORWARD = 'forward'
+MESSAGE_DURABILITY = os.environ.get('MESSAGE_DURABILITY', MESSAGE_DURABILITY_ACK)
+if MESSAGE_DURABILITY not in (MESSAGE_DURABILITY_ACK, MESSAGE_DURABILITY_FORWARD):
+    raise NotImplementedError(f'Message durability {MESSAGE_DURABILITY} is not supported')
+# Messages older than a website retention are archived to compressed files, expired ones are removed by Mongo
+# a grace period later in case the archiving did not run
+ARCHIVE_DIR = os.environ.get('ARCHIVE_DIR', 'archive')
+ARCHIVE_INTERVAL = float(os.environ.get('ARCHIVE_INTERVAL', 3600))
+RETENTION_GRACE_DAYS = float(os.environ.get('RETENTION_GRACE_DAYS', 1))
+# Restored messages are kept for this long
+RESTORE_DAYS = float(os.environ.get('RESTORE_DAYS', 7))
+# Website metadata is cached in every process and invalidated by its changes, TTL only bounds missed invalidations
+WEBSITE_CACHE_TTL = float(os.environ.get('WEBSITE_CACHE_TTL', 300))
+WEBSITE_CACHE_SIZE = int(os.environ.get('WEBSITE_CACHE_SIZE', 10000))
+# Telegram messages sent to operators are mapped to their chats for this long, so replies are routed by the mapping
+ROUTE_DAYS = float(os.environ.get('ROUTE_DAYS', 30))
+ROUTE_CACHE_TTL = float(os.environ.get('ROUTE_CACHE_TTL', 3600))
+ROUTE_CACHE_SIZE = int(os.environ.get('ROUTE_CACHE_SIZE', 10000))
 
 CRYPT_SCHEMES = ['bcrypt', 'argon2', 'scrypt']
 CRYPT_DEFAULT = 'bcrypt'
@@ -16,15 +47,25 @@ CRYPT_CFG = {
     'default': CRYPT_DEFAULT,
     'bcrypt__rounds': 14
 }
+# Hashing takes about a second of CPU, so it runs in worker processes, which is also the most run at once
+PASSWORD_WORKERS = int(os.environ.get('PASSWORD_WORKERS', 2))
+# Successful verifications are remembered for a while, so repeated operations are not hashed again
+PASSWORD_CACHE_TTL = float(os.environ.get('PASSWORD_CACHE_TTL', 300))
+PASSWORD_CACHE_SIZE = 1000
 
 DATABASE = 'tgchat'
 WEBSITES_COL = 'websites'
+SESSIONS_COL = 'sessions'
+MESSAGES_COL = 'messages'
+META_COL = 'meta'
+ROUTES_COL = 'routes'
 
 
 class MongoManager:
     class __MongoManager:
         def __init__(self):
-            self.client = pymongo.MongoClient(MONGODB_HOST, MONGODB_PORT)
+            # One client and its connection pool is shared by everything in the process
+            self.client = AsyncIOMotorClient(MONGODB_HOST, MONGODB_PORT, maxPoolSize=MONGODB_POOL_SIZE)
 
     __instance = None
 
@@ -36,10 +77,48 @@ class MongoManager:
         return getattr(self.__instance, item)
 
 
+_worker_ctx = None
+
+
+def _get_worker_ctx() -> CryptContext:
+    global _worker_ctx
+    if not _worker_ctx:
+        _worker_ctx = CryptContext(**CRYPT_CFG)
+    return _worker_ctx
+
+
+def _hash_password(password: str) -> str:
+    return _get_worker_ctx().hash(password)
+
+
+def _verify_password(password: str, password_hash: str) -> bool:
+    return _get_worker_ctx().verify(password, password_hash)
+
+
 class PasswordManager:
     class __PasswordManager:
         def __init__(self):
             self.ctx = CryptContext(**CRYPT_CFG)
+            self._executor = ProcessPoolExecutor(max_workers=PASSWORD_WORKERS)
+            self._slots = asyncio.Semaphore(PASSWORD_WORKERS)
+            self._verified = TTLCache(PASSWORD_CACHE_TTL, PASSWORD_CACHE_SIZE)
+
+        async def _run(self, function, *args):
+            async with self._slots:
+                return await asyncio.get_event_loop().run_in_executor(self._executor, function, *args)
+
+        async def hash(self, password: str) -> str:
+            return await self._run(_hash_password, password)
+
+        async def verify(self, password: str, password_hash: str, scope: str = '') -> bool:
+            # The hash is a part of the key, so a changed password is verified again
+            key = hashlib.sha256('\0'.join((scope, password, password_hash)).encode()).hexdigest()
+            if self._verified.get(key, False):
+                return True
+            verified = await self._run(_verify_password, password, password_hash)
+            if verified:
+                self._verified.set(key, True)
+            return verified
 
     __instance = None
 
@@ -1,13 +1,28 @@
+import asyncio
 from dataclasses import dataclass
-from typing import List
+from datetime import datetime, timedelta
+from typing import List, AsyncIterator, Tuple, Set, Union
 
 import pymongo
 from dataclasses_json import dataclass_json
+from pymongo.errors import BulkWriteError
 
-from db.base import MongoManager, DATABASE
-from db.website import get_website_sessions_keys
+from db.base import MongoManager, DATABASE, MESSAGES_COL, MESSAGE_WRITE_BATCH_SIZE, MESSAGE_WRITE_MAX_DELAY_MS, \
+    MESSAGE_DURABILITY, MESSAGE_DURABILITY_ACK, RETENTION_GRACE_DAYS
+from db.website import TOKEN_KEY, SESSION_KEY, validate_website_session, get_website_retention
+from helpers.ids import ID_EPOCH_MS, NODE_BITS, SEQUENCE_BITS, id_to_timestamp
 
 TIMESTAMP_KEY = 'timestamp'
+TEXT_KEY = 'text'
+SCORE_KEY = 'score'
+ID_KEY = 'id'
+EXPIRE_AT_KEY = 'expire_at'
+# Set for messages restored from an archive, which are kept only for a while and never archived again
+RESTORED_KEY = 'restored'
+# Storage fields, which are not a part of a message
+MESSAGE_PROJECTION = {'_id': 0, EXPIRE_AT_KEY: 0, RESTORED_KEY: 0}
+DUPLICATE_KEY_ERROR = 11000
+UNIX_EPOCH = datetime(1970, 1, 1)
 
 
 @dataclass_json
@@ -19,39 +34,159 @@ class ChatMessage:
     session: str = ''
     user: str = ''
     username: str = ''
+    # Unique and ordered within a session, see helpers.ids
+    id: int = 0
 
 
-def get_session_col_name(token: str, session_key: str):
-    return f'{token[-12:]}::session: {session_key[-12:]}'
+async def get_messages_col():
+    return MongoManager().client[DATABASE][MESSAGES_COL]
 
 
-def get_session_col(token: str, session_key: str):
-    db = MongoManager().client[DATABASE]
-    sessions = get_website_sessions_keys(token)
-    if session_key not in sessions:
-        raise Exception(f'Invalid session key')
-    session = db[get_session_col_name(token, session_key)]
-    if 'search_index' not in session.index_information():
-        session.create_index(TIMESTAMP_KEY, name='search_index', unique=True)
-    return session
+def get_retention_lifetime(retention_days: float) -> timedelta:
+    return timedelta(days=retention_days + RETENTION_GRACE_DAYS)
 
 
-def add_message(message: ChatMessage) -> bool:
+async def to_document(message: ChatMessage) -> dict:
+    document = message.to_dict()
+    retention_days = await get_website_retention(message.token)
+    if retention_days:
+        # Same as apply_retention, archiving is based on IDs too
+        created = datetime.utcfromtimestamp(id_to_timestamp(message.id)) if message.id else datetime.utcnow()
+        document[EXPIRE_AT_KEY] = created + get_retention_lifetime(retention_days)
+    return document
+
+
+async def apply_retention(token: str, retention_days: float):
+    # Stored messages expire according to their IDs assigned by the server, timestamps are given by clients.
+    # The ones restored from archives are left as they are
+    messages = await get_messages_col()
+    query = {TOKEN_KEY: token, RESTORED_KEY: {'$exists': False}}
+    if not retention_days:
+        await messages.update_many(query, {'$unset': {EXPIRE_AT_KEY: ''}})
+        return
+    lifetime_ms = get_retention_lifetime(retention_days).total_seconds() * 1000
+    # Bit shifts are not available in older Mongo, dividing by a power of two is exact
+    created_ms = {'$add': [ID_EPOCH_MS, {'$floor': {'$divide': [f'${ID_KEY}', 1 << (NODE_BITS + SEQUENCE_BITS)]}}]}
+    await messages.update_many(query, [{'$set': {EXPIRE_AT_KEY: {'$add': [UNIX_EPOCH, created_ms, lifetime_ms]}}}])
+
+
+async def add_message(message: ChatMessage) -> bool:
     try:
-        session = get_session_col(message.token, message.session)
-        session.insert_one(message.to_dict())
+        if not await validate_website_session(message.token, message.session):
+            raise Exception(f'Invalid session key')
+        messages = await get_messages_col()
+        await messages.insert_one(await to_document(message))
         return True
     except Exception as e:
         print(e)
         return False
 
 
-def get_messages(token: str, session_key: str, amount: int = 10, full: bool = False) -> List[ChatMessage]:
-    session = get_session_col(token, session_key)
-    if not list(session.find()):
-        return []
-    if full:
-        messages = session.find().sort(TIMESTAMP_KEY, pymongo.DESCENDING)
-    else:
-        messages = session.find().limit(amount).sort(TIMESTAMP_KEY, pymongo.DESCENDING)
-    return [ChatMessage.from_dict(msg) for msg in messages]
+class MessageWriter:
+    def __init__(self, batch_size: int = MESSAGE_WRITE_BATCH_SIZE, max_delay_ms: float = MESSAGE_WRITE_MAX_DELAY_MS,
+                 durability: str = MESSAGE_DURABILITY):
+        self._batch_size = batch_size
+        self._delay = max_delay_ms / 1000
+        self._durability = durability
+        self._batch: List[Tuple[dict, asyncio.Future]] = []
+        self._timer: Union[asyncio.TimerHandle, None] = None
+        self._lock = asyncio.Lock()
+        self._writes: Set[asyncio.Task] = set()
+        # Batches being written or waiting for the previous ones
+        self._writing = 0
+
+    async def _write(self, batch: List[Tuple[dict, asyncio.Future]]):
+        # Batches are written one after another to keep the order of messages
+        async with self._lock:
+            results = [True] * len(batch)
+            try:
+                messages = await get_messages_col()
+                await messages.insert_many([message for message, _ in batch], ordered=False)
+            except BulkWriteError as e:
+                for error in e.details['writeErrors']:
+                    # Duplicates are messages stored already
+                    if error['code'] != DUPLICATE_KEY_ERROR:
+                        results[error['index']] = False
+                        print(f'Message write failed: {error["errmsg"]}')
+            except Exception as e:
+                print(f'Messages batch write failed: {e!r}')
+                results = [False] * len(batch)
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+        self._writing -= 1
+        # Messages which came during the write go next as one batch
+        if self._batch and not self._writing:
+            self._flush()
+
+    def _flush(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._batch = self._batch, []
+        if batch:
+            self._writing += 1
+            task = asyncio.get_event_loop().create_task(self._write(batch))
+            self._writes.add(task)
+            task.add_done_callback(self._writes.discard)
+
+    def write(self, document: dict) -> asyncio.Future:
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self._batch.append((document, future))
+        # Group commit, a message is written right away unless a write is running already
+        if len(self._batch) >= self._batch_size or not self._writing:
+            self._flush()
+        elif not self._timer:
+            self._timer = loop.call_later(self._delay, self._flush)
+        return future
+
+    async def store(self, message: ChatMessage) -> bool:
+        # Either waits for the message to be written or lets it be forwarded right away
+        try:
+            document = await to_document(message)
+        except Exception as e:
+            print(f'Message write failed: {e!r}')
+            return False
+        future = self.write(document)
+        if self._durability == MESSAGE_DURABILITY_ACK:
+            return await future
+        return True
+
+    async def close(self):
+        self._flush()
+        if self._writes:
+            await asyncio.gather(*self._writes)
+
+
+message_writer = MessageWriter()
+
+
+async def iter_messages(token: str, session_key: str, before: int = 0, amount: int = 0) -> AsyncIterator[ChatMessage]:
+    # Newest first, continued from the ID of the last message seen instead of skipping over the older pages
+    messages = await get_messages_col()
+    query = {TOKEN_KEY: token, SESSION_KEY: session_key}
+    if before:
+        query[ID_KEY] = {'$lt': before}
+    async for msg in messages.find(query, MESSAGE_PROJECTION, limit=amount).sort(ID_KEY, pymongo.DESCENDING):
+        yield ChatMessage.from_dict(msg)
+
+
+async def get_messages(token: str, session_key: str, amount: int = 10, full: bool = False,
+                       before: int = 0) -> List[ChatMessage]:
+    return [msg async for msg in iter_messages(token, session_key, before, 0 if full else amount)]
+
+
+async def _search_website(messages, token: str, query: str, amount: int) -> List[dict]:
+    cursor = messages.find({TOKEN_KEY: token, '$text': {'$search': query}},
+                           {**MESSAGE_PROJECTION, SCORE_KEY: {'$meta': 'textScore'}}, limit=amount)
+    return await cursor.sort([(SCORE_KEY, {'$meta': 'textScore'})]).to_list(None)
+
+
+async def search_messages(tokens: List[str], query: str, skip: int = 0, amount: int = 10) -> List[ChatMessage]:
+    # Text index is partitioned by token, so every website is searched on its own and the best matches are merged
+    messages = await get_messages_col()
+    found = await asyncio.gather(*[_search_website(messages, token, query, skip + amount) for token in tokens])
+    ranked = sorted((msg for msgs in found for msg in msgs), key=lambda msg: (msg[SCORE_KEY], msg[ID_KEY]),
+                    reverse=True)
+    return [ChatMessage.from_dict(msg) for msg in ranked[skip:skip + amount]]
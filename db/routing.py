@@ -0,0 +1,65 @@
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import List, Tuple, Union
+
+import pymongo
+from pymongo.errors import BulkWriteError
+
+from db.base import MongoManager, DATABASE, ROUTES_COL, ROUTE_DAYS, ROUTE_CACHE_TTL, ROUTE_CACHE_SIZE
+from db.messaging import TEXT_KEY, EXPIRE_AT_KEY, DUPLICATE_KEY_ERROR
+from db.website import TOKEN_KEY, SESSION_KEY
+from helpers.cache import TTLCache, MISSING
+
+CHAT_ID_KEY = 'chat_id'
+MESSAGE_ID_KEY = 'message_id'
+USER_KEY = 'user'
+ROUTES_INDEX = [(CHAT_ID_KEY, pymongo.ASCENDING), (MESSAGE_ID_KEY, pymongo.ASCENDING)]
+
+
+@dataclass(frozen=True)
+class Route:
+    # Chat a Telegram message was about and the visitor text it showed
+    token: str
+    session: str
+    user: str = ''
+    text: str = ''
+
+
+# Chat and message IDs to their routes. Messages which are not routed are not cached, their routes may be stored a
+# moment later, and replies to them are parsed anyway
+_routes_cache = TTLCache(ROUTE_CACHE_TTL, ROUTE_CACHE_SIZE)
+
+
+async def get_routes_col():
+    return MongoManager().client[DATABASE][ROUTES_COL]
+
+
+async def add_routes(messages: List[Tuple[int, int]], route: Route):
+    # Messages are given by their chat and message IDs
+    if not messages:
+        return
+    for message in messages:
+        _routes_cache.set(message, route)
+    expire_at = datetime.utcnow() + timedelta(days=ROUTE_DAYS)
+    routes = await get_routes_col()
+    documents = [{CHAT_ID_KEY: chat_id, MESSAGE_ID_KEY: message_id, TOKEN_KEY: route.token,
+                  SESSION_KEY: route.session, USER_KEY: route.user, TEXT_KEY: route.text, EXPIRE_AT_KEY: expire_at}
+                 for chat_id, message_id in messages]
+    try:
+        await routes.insert_many(documents, ordered=False)
+    except BulkWriteError as e:
+        if any(error['code'] != DUPLICATE_KEY_ERROR for error in e.details['writeErrors']):
+            raise
+
+
+async def get_route(chat_id: int, message_id: int) -> Union[Route, None]:
+    key = (chat_id, message_id)
+    route = _routes_cache.get(key)
+    if route is MISSING:
+        routes = await get_routes_col()
+        document = await routes.find_one({CHAT_ID_KEY: chat_id, MESSAGE_ID_KEY: message_id})
+        if not document:
+            return None
+        route = Route(document[TOKEN_KEY], document[SESSION_KEY], document[USER_KEY], document[TEXT_KEY])
+        _routes_cache.set(key, route)
+    return route
@@ -0,0 +1,194 @@
+import asyncio
+import uuid
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, List
+
+import pymongo
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+from db.base import MongoManager, DATABASE, WEBSITES_COL, SESSIONS_COL, MESSAGES_COL, META_COL, ROUTES_COL
+from db.messaging import TIMESTAMP_KEY, TEXT_KEY, ID_KEY, EXPIRE_AT_KEY, DUPLICATE_KEY_ERROR
+from db.routing import ROUTES_INDEX
+from db.website import TOKEN_KEY, HOST_KEY, SUBS_KEY, USER_CHANNEL_KEY, SESSIONS_KEY, SESSION_KEY, SESSION_END_KEY, \
+    BANNED_KEY, NODE_KEY, get_session_end
+from helpers.ids import id_from_timestamp
+
+SCHEMA_ID = 'schema'
+VERSION_KEY = 'version'
+# Lock is held for migrations, it is renewed while they run and expires if the process dies
+MIGRATION_LOCK_ID = 'migration_lock'
+OWNER_KEY = 'owner'
+LOCKED_UNTIL_KEY = 'locked_until'
+MIGRATION_LOCK_TTL = 60
+MIGRATION_LOCK_POLL = 1.0
+# Messages used to be stored in a collection per session named '<token end>::session: <session end>'
+SESSION_COL_SEPARATOR = '::session: '
+MIGRATION_BATCH_SIZE = 1000
+MESSAGES_INDEX = [(TOKEN_KEY, pymongo.ASCENDING), (SESSION_KEY, pymongo.ASCENDING), (ID_KEY, pymongo.ASCENDING)]
+# Messages used to be unique by their timestamp in seconds
+TIMESTAMP_MESSAGES_INDEX = [(TOKEN_KEY, pymongo.ASCENDING), (SESSION_KEY, pymongo.ASCENDING),
+                            (TIMESTAMP_KEY, pymongo.ASCENDING)]
+
+
+async def create_indexes(db: AsyncIOMotorDatabase):
+    # Creating an existing index is a no-op, so this also verifies them
+    websites = db[WEBSITES_COL]
+    await websites.create_index(TOKEN_KEY, name='search_index', unique=True)
+    await websites.create_index(HOST_KEY, unique=True)
+    await websites.create_index(f'{SUBS_KEY}.{USER_CHANNEL_KEY}')
+    sessions = db[SESSIONS_COL]
+    await sessions.create_index([(TOKEN_KEY, pymongo.ASCENDING), (SESSION_KEY, pymongo.ASCENDING)], unique=True)
+    await sessions.create_index([(TOKEN_KEY, pymongo.ASCENDING), (SESSION_END_KEY, pymongo.ASCENDING)])
+    await sessions.create_index(BANNED_KEY, partialFilterExpression={BANNED_KEY: True})
+    await sessions.create_index(NODE_KEY, partialFilterExpression={NODE_KEY: {'$exists': True}})
+    # Serves every history query and is suitable as the shard key of the collection
+    await db[MESSAGES_COL].create_index(MESSAGES_INDEX, name='search_index', unique=True)
+    await db[MESSAGES_COL].create_index(EXPIRE_AT_KEY, expireAfterSeconds=0)
+    # Searches are scoped to websites, chats have no single language, so words are not stemmed
+    await db[MESSAGES_COL].create_index([(TOKEN_KEY, pymongo.ASCENDING), (TEXT_KEY, pymongo.TEXT)], name='text_index',
+                                        default_language='none')
+    await db[ROUTES_COL].create_index(ROUTES_INDEX, unique=True)
+    await db[ROUTES_COL].create_index(EXPIRE_AT_KEY, expireAfterSeconds=0)
+
+
+async def index_session_cols(db: AsyncIOMotorDatabase):
+    # Session collections used to be indexed on their first access only
+    for name in await db.list_collection_names(filter={'name': {'$regex': SESSION_COL_SEPARATOR}}):
+        await db[name].create_index(TIMESTAMP_KEY, name='search_index', unique=True)
+
+
+async def move_sessions(db: AsyncIOMotorDatabase):
+    # Sessions embedded into website documents get their own collection
+    websites = db[WEBSITES_COL]
+    await db[SESSIONS_COL].create_index([(TOKEN_KEY, pymongo.ASCENDING), (SESSION_KEY, pymongo.ASCENDING)],
+                                        unique=True)
+    async for website in websites.find({SESSIONS_KEY: {'$exists': True}}, {TOKEN_KEY: 1, SESSIONS_KEY: 1}):
+        requests = [pymongo.UpdateOne({TOKEN_KEY: website[TOKEN_KEY], SESSION_KEY: session[SESSION_KEY]},
+                                      {'$setOnInsert': {SESSION_END_KEY: get_session_end(session[SESSION_KEY]),
+                                                        BANNED_KEY: session.get(BANNED_KEY, False)}},
+                                      upsert=True)
+                    for session in website[SESSIONS_KEY] or []]
+        if requests:
+            await db[SESSIONS_COL].bulk_write(requests, ordered=False)
+        await websites.update_one({'_id': website['_id']}, {'$unset': {SESSIONS_KEY: ''}})
+
+
+async def _insert_messages(db: AsyncIOMotorDatabase, batch: List[dict]):
+    try:
+        await db[MESSAGES_COL].insert_many(batch, ordered=False)
+    except BulkWriteError as e:
+        # Messages copied by an interrupted run are already there
+        if any(error['code'] != DUPLICATE_KEY_ERROR for error in e.details['writeErrors']):
+            raise
+
+
+async def merge_session_cols(db: AsyncIOMotorDatabase):
+    # Every message carries its token and session, so the collections are streamed into one
+    await db[MESSAGES_COL].create_index(TIMESTAMP_MESSAGES_INDEX, name='search_index', unique=True)
+    for name in await db.list_collection_names(filter={'name': {'$regex': SESSION_COL_SEPARATOR}}):
+        batch = []
+        async for message in db[name].find({}, {'_id': 0}):
+            batch.append(message)
+            if len(batch) >= MIGRATION_BATCH_SIZE:
+                await _insert_messages(db, batch)
+                batch = []
+        if batch:
+            await _insert_messages(db, batch)
+        await db[name].drop()
+
+
+async def assign_message_ids(db: AsyncIOMotorDatabase):
+    # Timestamps were unique within a session, so IDs made of them are unique as well
+    messages = db[MESSAGES_COL]
+    requests = []
+    async for message in messages.find({ID_KEY: {'$exists': False}}, {TIMESTAMP_KEY: 1}):
+        requests.append(pymongo.UpdateOne({'_id': message['_id']},
+                                          {'$set': {ID_KEY: id_from_timestamp(message[TIMESTAMP_KEY])}}))
+        if len(requests) >= MIGRATION_BATCH_SIZE:
+            await messages.bulk_write(requests, ordered=False)
+            requests = []
+    if requests:
+        await messages.bulk_write(requests, ordered=False)
+    indexes = await messages.index_information()
+    if 'search_index' in indexes and indexes['search_index']['key'] == TIMESTAMP_MESSAGES_INDEX:
+        await messages.drop_index('search_index')
+
+
+# Migration at index N brings the data from version N to N + 1, new ones are only appended.
+# Processes may start at once, so every migration should be safe to run twice
+MIGRATIONS: List[Callable[[AsyncIOMotorDatabase], Awaitable]] = [
+    index_session_cols,
+    move_sessions,
+    merge_session_cols,
+    assign_message_ids,
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+_bootstrap_task = None
+
+
+async def get_schema_version(db: AsyncIOMotorDatabase) -> int:
+    schema = await db[META_COL].find_one({'_id': SCHEMA_ID})
+    return schema[VERSION_KEY] if schema else 0
+
+
+async def _lock_migrations(db: AsyncIOMotorDatabase, owner: str) -> bool:
+    # Takes the lock if it is free, expired or already owned, the latter extends it
+    now = datetime.utcnow()
+    try:
+        await db[META_COL].update_one({'_id': MIGRATION_LOCK_ID,
+                                       '$or': [{LOCKED_UNTIL_KEY: {'$lt': now}}, {OWNER_KEY: owner}]},
+                                      {'$set': {OWNER_KEY: owner,
+                                                LOCKED_UNTIL_KEY: now + timedelta(seconds=MIGRATION_LOCK_TTL)}},
+                                      upsert=True)
+        return True
+    except DuplicateKeyError:
+        return False
+
+
+async def _keep_migrations_locked(db: AsyncIOMotorDatabase, owner: str):
+    while True:
+        await asyncio.sleep(MIGRATION_LOCK_TTL / 3)
+        await _lock_migrations(db, owner)
+
+
+async def migrate(db: AsyncIOMotorDatabase):
+    version = await get_schema_version(db)
+    if version > SCHEMA_VERSION:
+        raise Exception(f'Database schema version {version} is newer than supported {SCHEMA_VERSION}')
+    if version == SCHEMA_VERSION:
+        return
+    # Processes starting at once migrate one after another, a migration must not remove what another one still reads
+    owner = uuid.uuid4().hex
+    if not await _lock_migrations(db, owner):
+        print('Waiting for the database schema migration of another process')
+        while not await _lock_migrations(db, owner):
+            await asyncio.sleep(MIGRATION_LOCK_POLL)
+    keeper = asyncio.ensure_future(_keep_migrations_locked(db, owner))
+    try:
+        for version in range(await get_schema_version(db), SCHEMA_VERSION):
+            print(f'Migrating database schema to version {version + 1}')
+            await MIGRATIONS[version](db)
+            await db[META_COL].update_one({'_id': SCHEMA_ID}, {'$set': {VERSION_KEY: version + 1}}, upsert=True)
+    finally:
+        keeper.cancel()
+        await db[META_COL].delete_one({'_id': MIGRATION_LOCK_ID, OWNER_KEY: owner})
+
+
+async def _bootstrap():
+    db = MongoManager().client[DATABASE]
+    await migrate(db)
+    await create_indexes(db)
+
+
+async def bootstrap():
+    # Both the bot and WS server may run in one process, the schema is checked once
+    global _bootstrap_task
+    if not _bootstrap_task:
+        _bootstrap_task = asyncio.ensure_future(_bootstrap())
+    await _bootstrap_task
+
+
+if __name__ == '__main__':
+    asyncio.get_event_loop().run_until_complete(bootstrap())
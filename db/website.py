@@ -1,8 +1,10 @@
-import re
+import asyncio
 import uuid
-from typing import List
+from typing import List, Callable, Awaitable, Union
 
-from db.base import MongoManager, DATABASE, WEBSITES_COL, PasswordManager
+from db.base import MongoManager, DATABASE, WEBSITES_COL, SESSIONS_COL, PasswordManager, WEBSITE_CACHE_TTL, \
+    WEBSITE_CACHE_SIZE
+from helpers.cache import TTLCache, MISSING
 
 TOKEN_KEY = 'token'
 USERNAME_KEY = 'username'
@@ -12,9 +14,16 @@ ALIAS_KEY = 'alias'
 CREATOR_KEY = 'creator'
 PASSWORD_KEY = 'password'
 SUBS_KEY = 'subscribers'
-SESSIONS_KEY = 'sessions'
+# Days to keep messages for, 0 keeps them forever
+RETENTION_KEY = 'retention_days'
 SESSION_KEY = 'session'
+SESSION_END_KEY = 'session_end'
 BANNED_KEY = 'banned'
+# WS node holding the visitor socket, and the latest reply the visitor was reported gone for
+NODE_KEY = 'node'
+LEFT_REPLY_KEY = 'left_reply'
+# Sessions used to be embedded into their website documents
+SESSIONS_KEY = 'sessions'
 WEBSITES_PROTO = {
     TOKEN_KEY: '',
     HOST_KEY: '',
@@ -22,83 +31,156 @@ WEBSITES_PROTO = {
     CREATOR_KEY: '',
     PASSWORD_KEY: '',
     SUBS_KEY: None,
-    SESSIONS_KEY: None,
+    RETENTION_KEY: 0,
+}
+SESSIONS_PROTO = {
+    TOKEN_KEY: '',
+    SESSION_KEY: '',
+    SESSION_END_KEY: '',
+    BANNED_KEY: False,
+}
+# Everything but credentials and sessions is cached
+CACHED_PROJECTION = {
+    PASSWORD_KEY: 0,
+    SESSIONS_KEY: 0,
 }
 
+# Token to the website metadata or None for unknown tokens, host to the token or an empty string
+_websites_cache = TTLCache(WEBSITE_CACHE_TTL, WEBSITE_CACHE_SIZE)
+_hosts_cache = TTLCache(WEBSITE_CACHE_TTL, WEBSITE_CACHE_SIZE)
+_invalidation_listeners: List[Callable[[str, str], Awaitable]] = []
+_ban_listeners: List[Callable[[str, str, bool], Awaitable]] = []
+
+
+async def get_websites_col():
+    return MongoManager().client[DATABASE][WEBSITES_COL]
+
+
+async def get_sessions_col():
+    return MongoManager().client[DATABASE][SESSIONS_COL]
 
-def get_websites_col():
-    db = MongoManager().client[DATABASE]
-    websites = db[WEBSITES_COL]
-    if 'search_index' not in websites.index_information():
-        websites.create_index(TOKEN_KEY, name='search_index', unique=True)
-        websites.create_index(HOST_KEY, unique=True)
-    return websites
 
+def get_session_end(session_key: str) -> str:
+    return session_key[-12:]
 
-def verify_login(website, password: str) -> bool:
-    return website and PasswordManager().ctx.verify(password, website[PASSWORD_KEY])
 
+async def verify_login(website, password: str) -> bool:
+    return bool(website) and await PasswordManager().verify(password, website[PASSWORD_KEY], website[TOKEN_KEY])
 
-def get_website_privileged(websites, token: str, password: str):
-    website = websites.find_one({TOKEN_KEY: token})
+
+async def get_website_privileged(websites, token: str, password: str):
+    website = await websites.find_one({TOKEN_KEY: token})
     if not website:
         raise Exception('Incorrect token')
-    if not verify_login(website, password):
+    if not await verify_login(website, password):
         raise Exception('Incorrect credentials')
     return website
 
 
-def get_website(websites, token: str):
-    website = websites.find_one({TOKEN_KEY: token})
+def add_ban_listener(listener: Callable[[str, str, bool], Awaitable]):
+    _ban_listeners.append(listener)
+
+
+def add_invalidation_listener(listener: Callable[[str, str], Awaitable]):
+    _invalidation_listeners.append(listener)
+
+
+async def invalidate_website(token: str, host: str = '', notify: bool = True):
+    website = _websites_cache.pop(token)
+    host = host or (website[HOST_KEY] if website else '')
+    _hosts_cache.pop(host)
+    if notify:
+        # Lets other processes drop their copies as well
+        for listener in _invalidation_listeners:
+            await listener(token, host)
+
+
+def _cache_website(website, versions=None):
+    websites_version, hosts_version = versions or (None, None)
+    _websites_cache.set(website[TOKEN_KEY], website, websites_version)
+    _hosts_cache.set(website[HOST_KEY], website[TOKEN_KEY], hosts_version)
+
+
+def _cache_versions():
+    return _websites_cache.version, _hosts_cache.version
+
+
+async def get_cached_website(token: str) -> Union[dict, None]:
+    website = _websites_cache.get(token)
+    if website is MISSING:
+        versions = _cache_versions()
+        websites = await get_websites_col()
+        website = await websites.find_one({TOKEN_KEY: token}, CACHED_PROJECTION)
+        if website:
+            _cache_website(website, versions)
+        else:
+            _websites_cache.set(token, None, versions[0])
+    return website
+
+
+async def load_websites_cache():
+    versions = _cache_versions()
+    websites = await get_websites_col()
+    async for website in websites.find({}, CACHED_PROJECTION).limit(WEBSITE_CACHE_SIZE):
+        _cache_website(website, versions)
+
+
+async def get_website(websites, token: str):
+    website = await websites.find_one({TOKEN_KEY: token})
     if not website:
         raise Exception('Incorrect token')
     return website
 
 
-def get_full_token(token_end: str) -> str:
-    websites = get_websites_col()
-    website = websites.find_one({TOKEN_KEY: {'$regex': f'-{token_end}$'}})
+async def get_full_token(token_end: str) -> str:
+    websites = await get_websites_col()
+    website = await websites.find_one({TOKEN_KEY: {'$regex': f'-{token_end}$'}})
     if website:
         return website[TOKEN_KEY]
     return ''
 
 
-def get_token_from_host(host: str) -> str:
-    websites = get_websites_col()
-    website = websites.find_one({HOST_KEY: host})
-    if website:
-        return website[TOKEN_KEY]
-    return ''
+async def get_token_from_host(host: str) -> str:
+    token = _hosts_cache.get(host)
+    if token is MISSING:
+        versions = _cache_versions()
+        websites = await get_websites_col()
+        website = await websites.find_one({HOST_KEY: host}, CACHED_PROJECTION)
+        if website:
+            _cache_website(website, versions)
+            return website[TOKEN_KEY]
+        _hosts_cache.set(host, '', versions[1])
+        return ''
+    return token
 
 
-def get_host_from_token(token: str) -> str:
-    websites = get_websites_col()
-    website = websites.find_one({TOKEN_KEY: token})
+async def get_host_from_token(token: str) -> str:
+    website = await get_cached_website(token)
     if website:
         return website[HOST_KEY]
     return ''
 
 
-def get_full_session_key(token: str, session_end: str) -> str:
-    try:
-        websites = get_websites_col()
-        website = get_website(websites, token)
-        sessions = [ses[SESSION_KEY] for ses in website[SESSIONS_KEY]]
-        return list(filter(re.compile(f'-{session_end}$').search, sessions))[0]
-    except Exception as e:
-        print(e)
-        return ''
+async def get_full_session_key(token: str, session_end: str) -> str:
+    sessions = await get_sessions_col()
+    session = await sessions.find_one({TOKEN_KEY: token, SESSION_END_KEY: session_end}, {SESSION_KEY: 1})
+    if session:
+        return session[SESSION_KEY]
+    return ''
 
 
-def delete_db():
-    MongoManager().client.drop_database(DATABASE)
+async def delete_db():
+    await MongoManager().client.drop_database(DATABASE)
+    _websites_cache.clear()
+    _hosts_cache.clear()
 
 
-def get_all_websites():
-    return list(get_websites_col().find({}))
+async def get_all_websites():
+    websites = await get_websites_col()
+    return await websites.find({}).to_list(None)
 
 
-def get_website_hosts():
+async def get_website_hosts():
     exception = {
         ALIAS_KEY: 0,
         CREATOR_KEY: 0,
@@ -106,10 +188,11 @@ def get_website_hosts():
         SUBS_KEY: 0,
         SESSIONS_KEY: 0,
     }
-    return list(get_websites_col().find({}, exception))
+    websites = await get_websites_col()
+    return await websites.find({}, exception).to_list(None)
 
 
-def get_website_tokens_hosts():
+async def get_website_tokens_hosts():
     exception = {
         ALIAS_KEY: 0,
         CREATOR_KEY: 0,
@@ -117,28 +200,22 @@ def get_website_tokens_hosts():
         SUBS_KEY: 0,
         SESSIONS_KEY: 0,
     }
-    return list(get_websites_col().find({}, exception))
+    websites = await get_websites_col()
+    return await websites.find({}, exception).to_list(None)
 
 
-def get_website_subscribers(token: str):
-    exception = {
-        HOST_KEY: 0,
-        ALIAS_KEY: 0,
-        CREATOR_KEY: 0,
-        PASSWORD_KEY: 0,
-        SESSIONS_KEY: 0,
-    }
-    query = get_websites_col().find_one({TOKEN_KEY: token}, exception)
-    if query:
-        return query[SUBS_KEY]
+async def get_website_subscribers(token: str):
+    website = await get_cached_website(token)
+    if website:
+        return website[SUBS_KEY]
     return []
 
 
-def add_website(username: str, user_channel: int, host: str, alias: str, password: str) -> str:
+async def add_website(username: str, user_channel: int, host: str, alias: str, password: str) -> str:
     try:
-        websites = get_websites_col()
+        websites = await get_websites_col()
         token = f'{uuid.uuid4()}'
-        password_hash = PasswordManager().ctx.hash(password)
+        password_hash = await PasswordManager().hash(password)
         website = {
             TOKEN_KEY: token,
             HOST_KEY: host,
@@ -146,117 +223,148 @@ def add_website(username: str, user_channel: int, host: str, alias: str, passwor
             CREATOR_KEY: username,
             PASSWORD_KEY: password_hash,
             SUBS_KEY: [{USERNAME_KEY: username, USER_CHANNEL_KEY: user_channel}],
-            SESSIONS_KEY: []
+            RETENTION_KEY: 0,
         }
-        websites.insert_one(website)
+        await websites.insert_one(website)
+        # The host may be cached as unknown
+        await invalidate_website(token, host)
         return token
     except Exception as e:
         print(e)
         return ''
 
 
-def remove_website(username: str, token: str, password: str) -> str:
+async def remove_website(username: str, token: str, password: str) -> str:
     try:
-        websites = get_websites_col()
-        website = get_website_privileged(websites, token, password)
+        websites = await get_websites_col()
+        website = await get_website_privileged(websites, token, password)
         alias = website[ALIAS_KEY]
         if username != website[CREATOR_KEY]:
             return 'Only creator is allowed to remove a website'
-        websites.delete_one(website)
+        await websites.delete_one(website)
+        await (await get_sessions_col()).delete_many({TOKEN_KEY: token})
+        await invalidate_website(token, website[HOST_KEY])
         return alias
     except Exception as e:
         print(e)
         return str(e)
 
 
-def create_session_website(token: str) -> str:
+async def create_session_website(token: str) -> str:
     try:
-        websites = get_websites_col()
-        website = get_website(websites, token)
+        if not await get_cached_website(token):
+            raise Exception('Incorrect token')
+        sessions = await get_sessions_col()
         session_key = f'{uuid.uuid4()}'
-        website[SESSIONS_KEY].append({SESSION_KEY: session_key, BANNED_KEY: False})
-        websites.replace_one({TOKEN_KEY: token}, website, upsert=True)
+        await sessions.insert_one({TOKEN_KEY: token,
+                                   SESSION_KEY: session_key,
+                                   SESSION_END_KEY: get_session_end(session_key),
+                                   BANNED_KEY: False})
         return session_key
     except Exception as e:
         print(e)
         return ''
 
 
-def validate_website_session(token: str, session_key: str) -> bool:
+async def validate_website_session(token: str, session_key: str) -> bool:
     try:
-        websites = get_websites_col()
-        website = get_website(websites, token)
-        if session_key in [ses[SESSION_KEY] for ses in website[SESSIONS_KEY]]:
-            return True
+        sessions = await get_sessions_col()
+        return bool(await sessions.find_one({TOKEN_KEY: token, SESSION_KEY: session_key}, {'_id': 1}))
     except Exception as e:
         print(e)
     return False
 
 
-def get_website_sessions(token: str) -> List[str]:
-    websites = get_websites_col()
-    website = get_website(websites, token)
-    return website[SESSIONS_KEY]
+async def get_website_sessions(token: str) -> List[dict]:
+    sessions = await get_sessions_col()
+    return await sessions.find({TOKEN_KEY: token}, {'_id': 0, SESSION_KEY: 1, BANNED_KEY: 1}).to_list(None)
 
 
-def get_website_sessions_keys(token: str) -> List[str]:
-    websites = get_websites_col()
-    website = get_website(websites, token)
-    return [ses[SESSION_KEY] for ses in website[SESSIONS_KEY]]
+async def get_website_sessions_keys(token: str) -> List[str]:
+    sessions = await get_sessions_col()
+    return await sessions.distinct(SESSION_KEY, {TOKEN_KEY: token})
 
 
-def ban_session(token: str, session: str) -> bool:
-    websites = get_websites_col()
-    website = get_website(websites, token)
-    for idx, ses in enumerate(website[SESSIONS_KEY]):
-        if ses[SESSION_KEY] == session:
-            website[SESSIONS_KEY][idx][BANNED_KEY] = True
-            websites.replace_one({TOKEN_KEY: token}, website, upsert=True)
-            return True
-    return False
+async def _set_session_banned(token: str, session: str, banned: bool) -> bool:
+    sessions = await get_sessions_col()
+    result = await sessions.update_one({TOKEN_KEY: token, SESSION_KEY: session}, {'$set': {BANNED_KEY: banned}})
+    if not result.matched_count:
+        return False
+    for listener in _ban_listeners:
+        await listener(token, session, banned)
+    return True
 
 
-def unban_session(token: str, session: str) -> bool:
-    websites = get_websites_col()
-    website = get_website(websites, token)
-    for idx, ses in enumerate(website[SESSIONS_KEY]):
-        if ses[SESSION_KEY] == session:
-            website[SESSIONS_KEY][idx][BANNED_KEY] = False
-            websites.replace_one({TOKEN_KEY: token}, website, upsert=True)
-            return True
-    return False
+async def ban_session(token: str, session: str) -> bool:
+    return await _set_session_banned(token, session, True)
+
+
+async def unban_session(token: str, session: str) -> bool:
+    return await _set_session_banned(token, session, False)
+
 
+async def get_banned_sessions() -> List[dict]:
+    sessions = await get_sessions_col()
+    return await sessions.find({BANNED_KEY: True}, {'_id': 0, TOKEN_KEY: 1, SESSION_KEY: 1}).to_list(None)
 
-def is_session_banned(token: str, session: str) -> bool:
-    websites = get_websites_col()
-    website = get_website(websites, token)
-    for idx, ses in enumerate(website[SESSIONS_KEY]):
-        if ses[SESSION_KEY] == session:
-            return website[SESSIONS_KEY][idx][BANNED_KEY]
+
+async def is_session_banned(token: str, session: str) -> bool:
+    sessions = await get_sessions_col()
+    session = await sessions.find_one({TOKEN_KEY: token, SESSION_KEY: session}, {BANNED_KEY: 1})
+    if session:
+        return session[BANNED_KEY]
     return False
 
 
-def subscribe_website(username: str, user_channel: int, token: str, password: str) -> str:
+async def set_session_node(token: str, session: str, node: str):
+    sessions = await get_sessions_col()
+    await sessions.update_one({TOKEN_KEY: token, SESSION_KEY: session}, {'$set': {NODE_KEY: node}})
+
+
+async def unset_session_node(token: str, session: str, node: str):
+    # The visitor may have reconnected to another node meanwhile
+    sessions = await get_sessions_col()
+    await sessions.update_one({TOKEN_KEY: token, SESSION_KEY: session, NODE_KEY: node}, {'$unset': {NODE_KEY: ''}})
+
+
+async def unset_node_sessions(node: str):
+    # Sockets of a node are gone once it restarts
+    sessions = await get_sessions_col()
+    await sessions.update_many({NODE_KEY: node}, {'$unset': {NODE_KEY: ''}})
+
+
+async def claim_left_reply(token: str, session: str, message_id: int) -> bool:
+    # Every WS node receives the reply, only one of them reports the visitor gone, and only if no node holds it
+    sessions = await get_sessions_col()
+    result = await sessions.update_one({TOKEN_KEY: token, SESSION_KEY: session, NODE_KEY: {'$exists': False},
+                                        LEFT_REPLY_KEY: {'$not': {'$gte': message_id}}},
+                                       {'$set': {LEFT_REPLY_KEY: message_id}})
+    return bool(result.modified_count)
+
+
+async def subscribe_website(username: str, user_channel: int, token: str, password: str) -> str:
     try:
-        websites = get_websites_col()
-        website = get_website_privileged(websites, token, password)
+        websites = await get_websites_col()
+        website = await get_website_privileged(websites, token, password)
         if username not in [user[USERNAME_KEY] for user in website[SUBS_KEY]]:
             website[SUBS_KEY].append({USERNAME_KEY: username, USER_CHANNEL_KEY: user_channel})
-            websites.replace_one({TOKEN_KEY: token}, website, upsert=True)
+            await websites.replace_one({TOKEN_KEY: token}, website, upsert=True)
+            await invalidate_website(token)
         return website[ALIAS_KEY]
     except Exception as e:
         print(e)
         return ''
 
 
-def unsubscribe_website(username: str, token: str, password: str) -> str:
+async def unsubscribe_website(username: str, token: str, password: str) -> str:
     try:
-        websites = get_websites_col()
-        website = get_website_privileged(websites, token, password)
+        websites = await get_websites_col()
+        website = await get_website_privileged(websites, token, password)
         for user in website[SUBS_KEY]:
             if user[USERNAME_KEY] == username:
                 website[SUBS_KEY].remove(user)
-                websites.replace_one({TOKEN_KEY: token}, website, upsert=True)
+                await websites.replace_one({TOKEN_KEY: token}, website, upsert=True)
+                await invalidate_website(token)
                 break
         return website[ALIAS_KEY]
     except Exception as e:
@@ -264,8 +372,29 @@ def unsubscribe_website(username: str, token: str, password: str) -> str:
         return ''
 
 
-def is_user_subscribed(username: str, token: str) -> bool:
-    subscribers = get_website_subscribers(token)
+async def set_website_retention(username: str, token: str, days: float) -> bool:
+    websites = await get_websites_col()
+    result = await websites.update_one({TOKEN_KEY: token, CREATOR_KEY: username}, {'$set': {RETENTION_KEY: days}})
+    if not result.matched_count:
+        return False
+    await invalidate_website(token)
+    return True
+
+
+async def get_website_retention(token: str) -> float:
+    website = await get_cached_website(token)
+    if website:
+        return website.get(RETENTION_KEY, 0)
+    return 0
+
+
+async def get_subscribed_tokens(user_channel: int) -> List[str]:
+    websites = await get_websites_col()
+    return await websites.distinct(TOKEN_KEY, {f'{SUBS_KEY}.{USER_CHANNEL_KEY}': user_channel})
+
+
+async def is_user_subscribed(username: str, token: str) -> bool:
+    subscribers = await get_website_subscribers(token)
     for sub in subscribers:
         if sub[USERNAME_KEY] == username:
             return True
@@ -273,7 +402,7 @@ def is_user_subscribed(username: str, token: str) -> bool:
 
 
 if __name__ == '__main__':
-    delete_db()
+    asyncio.get_event_loop().run_until_complete(delete_db())
     # print(get_all_websites())
     # token = add_website('test', 299617516, '127.0.0.1', 'Test Website', '12345678')
     # print(token)
@@ -0,0 +1,49 @@
+import time
+from collections import OrderedDict
+from typing import Hashable, Tuple, Union
+
+MISSING = object()
+
+
+class TTLCache:
+    def __init__(self, ttl: float, size: int):
+        self._ttl = ttl
+        self._size = size
+        # Key to expiration time and value, the least recently used entries go first
+        self._entries: 'OrderedDict[Hashable, Tuple[float, any]]' = OrderedDict()
+        # Changed by every removal, so values read before it are not stored back stale
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key: Hashable, default: any = MISSING) -> any:
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return default
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key: Hashable, value: any, version: Union[int, None] = None) -> bool:
+        if version is not None and version != self.version:
+            return False
+        self._entries[key] = (time.monotonic() + self._ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._size:
+            self._entries.popitem(last=False)
+        return True
+
+    def pop(self, key: Hashable, default: any = None) -> any:
+        self.version += 1
+        entry = self._entries.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def clear(self):
+        self.version += 1
+        self._entries.clear()
@@ -0,0 +1,57 @@
+import os
+import random
+import time
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Milliseconds since the epoch, node and sequence fit 53 bits, so IDs stay exact in JavaScript numbers too
+ID_EPOCH_MS = 1640995200000  # 2022-01-01
+NODE_BITS = 6
+SEQUENCE_BITS = 6
+MAX_NODE = (1 << NODE_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+# Every process generating IDs at once should have its own node
+MESSAGE_ID_NODE = int(os.environ.get('MESSAGE_ID_NODE', random.randint(0, MAX_NODE)))
+if not 0 <= MESSAGE_ID_NODE <= MAX_NODE:
+    raise ValueError(f'MESSAGE_ID_NODE should be within 0..{MAX_NODE}')
+
+
+def compose_id(ms: int, node: int = 0, sequence: int = 0) -> int:
+    return ((ms - ID_EPOCH_MS) << (NODE_BITS + SEQUENCE_BITS)) | (node << SEQUENCE_BITS) | sequence
+
+
+def id_from_timestamp(timestamp: float) -> int:
+    return compose_id(int(timestamp * 1000))
+
+
+def id_to_timestamp(message_id: int) -> float:
+    return ((message_id >> (NODE_BITS + SEQUENCE_BITS)) + ID_EPOCH_MS) / 1000
+
+
+class IdGenerator:
+    def __init__(self, node: int = MESSAGE_ID_NODE):
+        self._node = node
+        self._last_ms = 0
+        self._sequence = 0
+
+    def next(self) -> int:
+        # Never goes back, even if the clock does, and borrows the next millisecond once a sequence is exhausted
+        ms = max(int(time.time() * 1000), self._last_ms)
+        if ms == self._last_ms:
+            self._sequence += 1
+            if self._sequence > MAX_SEQUENCE:
+                ms += 1
+                self._sequence = 0
+        else:
+            self._sequence = 0
+        self._last_ms = ms
+        return compose_id(ms, self._node, self._sequence)
+
+
+_generator = IdGenerator()
+
+
+def new_message_id() -> int:
+    return _generator.next()
@@ -1,36 +1,244 @@
 import asyncio
-from typing import List
+import heapq
+import itertools
+import os
+import time
+from typing import List, Dict, Tuple, Callable, Awaitable, Union
 
 from aiogram import Bot, Dispatcher, executor
+from aiogram.bot.api import TelegramAPIServer, TELEGRAM_PRODUCTION
 from aiogram.contrib.fsm_storage.memory import MemoryStorage
+from aiogram.utils.exceptions import RetryAfter
+from aiohttp import web
+from dotenv import load_dotenv
 
+from db.archive import run_archiving
+from db.base import ARCHIVE_INTERVAL
+from db.messaging import message_writer
+from db.routing import Route, add_routes
+from db.schema import bootstrap
 from db.website import get_website_subscribers, USER_CHANNEL_KEY
+from helpers.cache import TTLCache, MISSING
 from telegram.handlers import BotStartHandleMixin, BotMessageHandleMixin, BotWebsitesMixin, BotCancelStateHandleMixin, \
-    BotBanningMixin
+    BotBanningMixin, BotArchiveMixin, BotSearchMixin
+from telegram.webhook import TG_WEBHOOK_URL, TG_WEBHOOK_SECRET, start_webhook_server
+
+
+load_dotenv()
+
+# Updates are received by long polling or posted by Telegram to a webhook
+TG_MODE_POLLING = 'polling'
+TG_MODE_WEBHOOK = 'webhook'
+TG_MODE = os.environ.get('TG_MODE', TG_MODE_POLLING)
+if TG_MODE not in (TG_MODE_POLLING, TG_MODE_WEBHOOK):
+    raise NotImplementedError(f'Telegram mode {TG_MODE} is not supported')
+if TG_MODE == TG_MODE_WEBHOOK and not TG_WEBHOOK_SECRET:
+    raise ValueError('TG_WEBHOOK_SECRET is required in webhook mode')
+# Another Bot API server, e.g. a local one or a fake one for tests
+TG_API_SERVER = os.environ.get('TG_API_SERVER', '')
+
+# Telegram limits: messages per second overall, per second to a chat and per minute to a group
+TG_GLOBAL_RATE = float(os.environ.get('TG_GLOBAL_RATE', 30))
+TG_CHAT_RATE = float(os.environ.get('TG_CHAT_RATE', 1))
+TG_GROUP_RATE_PER_MIN = float(os.environ.get('TG_GROUP_RATE_PER_MIN', 20))
+# Buckets of chats idle for this long are full again and are forgotten
+CHAT_BUCKETS_TTL = 120
+CHAT_BUCKETS_SIZE = 10000
+
+# Lower is sent first, operators see replies before new notifications
+PRIORITY_REPLY = 0
+PRIORITY_NOTIFICATION = 1
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self._rate = rate
+        self._capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        # Set by Telegram flood control
+        self.blocked_until = 0.0
+
+    def delay(self) -> float:
+        now = time.monotonic()
+        self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+        self._updated = now
+        delay = max(self.blocked_until - now, 0.0)
+        if self._tokens < 1:
+            delay = max(delay, (1 - self._tokens) / self._rate)
+        return delay
+
+    def consume(self):
+        self._tokens -= 1
+
+
+# Priority, order of submission, chat, send call and its result
+SendItem = Tuple[int, int, Union[int, str], Callable[[], Awaitable], asyncio.Future]
+
+
+class SendScheduler:
+    def __init__(self, global_rate: float = TG_GLOBAL_RATE, chat_rate: float = TG_CHAT_RATE,
+                 group_rate_per_min: float = TG_GROUP_RATE_PER_MIN):
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chat_rate = chat_rate
+        self._group_rate = group_rate_per_min / 60
+        self._group_capacity = group_rate_per_min
+        self._buckets = TTLCache(CHAT_BUCKETS_TTL, CHAT_BUCKETS_SIZE)
+        # Messages of a chat wait in its own heap, so a busy chat does not hold back the others
+        self._pending: Dict[Union[int, str], List[SendItem]] = {}
+        self._scheduled = set()
+        self._ready: Union[asyncio.PriorityQueue, None] = None
+        self._counter = itertools.count()
+
+    def _get_buckets(self, chat_id: Union[int, str]) -> List[TokenBucket]:
+        buckets = self._buckets.get(chat_id)
+        if buckets is MISSING:
+            buckets = [TokenBucket(self._chat_rate, 1)]
+            # Group chats have negative IDs
+            if isinstance(chat_id, int) and chat_id < 0:
+                buckets.append(TokenBucket(self._group_rate, self._group_capacity))
+        self._buckets.set(chat_id, buckets)
+        return buckets
+
+    def _schedule(self, chat_id: Union[int, str]):
+        priority, order, *_ = self._pending[chat_id][0]
+        delay = max(bucket.delay() for bucket in self._get_buckets(chat_id))
+        self._scheduled.add(chat_id)
+        if delay:
+            asyncio.get_event_loop().call_later(delay, self._ready.put_nowait, (priority, order, chat_id))
+        else:
+            self._ready.put_nowait((priority, order, chat_id))
+
+    async def submit(self, chat_id: Union[int, str], send: Callable[[], Awaitable],
+                     priority: int = PRIORITY_REPLY) -> any:
+        if not self._ready:
+            self._ready = asyncio.PriorityQueue()
+            asyncio.get_event_loop().create_task(self._run())
+        future = asyncio.get_event_loop().create_future()
+        heapq.heappush(self._pending.setdefault(chat_id, []), (priority, next(self._counter), chat_id, send, future))
+        if chat_id not in self._scheduled:
+            self._schedule(chat_id)
+        return await future
+
+    async def _run(self):
+        while True:
+            _, _, chat_id = await self._ready.get()
+            buckets = self._get_buckets(chat_id)
+            if max(bucket.delay() for bucket in buckets):
+                # Chat was blocked by flood control after it was scheduled
+                self._schedule(chat_id)
+                continue
+            delay = self._global.delay()
+            if delay:
+                await asyncio.sleep(delay)
+            for bucket in buckets + [self._global]:
+                bucket.consume()
+            item = heapq.heappop(self._pending[chat_id])
+            asyncio.get_event_loop().create_task(self._send(item, buckets))
+            if self._pending[chat_id]:
+                self._schedule(chat_id)
+            else:
+                del self._pending[chat_id]
+                self._scheduled.discard(chat_id)
+
+    async def _send(self, item: SendItem, buckets: List[TokenBucket]):
+        _, _, chat_id, send, future = item
+        try:
+            future.set_result(await send())
+        except RetryAfter as e:
+            print(f'Telegram flood control for {chat_id}, retrying in {e.timeout} s')
+            for bucket in buckets:
+                bucket.blocked_until = time.monotonic() + e.timeout
+            heapq.heappush(self._pending.setdefault(chat_id, []), item)
+            if chat_id not in self._scheduled:
+                self._schedule(chat_id)
+        except Exception as e:
+            future.set_exception(e)
+
+
+class ScheduledBot(Bot):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.scheduler = SendScheduler()
+
+    async def send_message(self, chat_id, text, *args, priority: int = PRIORITY_REPLY, **kwargs):
+        # Every message, including answers and replies of handlers, goes through the rate limits
+        send = super().send_message
+        return await self.scheduler.submit(chat_id, lambda: send(chat_id, text, *args, **kwargs), priority)
 
 
 class TelegramBotMixin(BotStartHandleMixin, BotMessageHandleMixin, BotWebsitesMixin, BotCancelStateHandleMixin,
-                       BotBanningMixin):
-    def __init__(self, *args, tg_token, **kwargs):
+                       BotBanningMixin, BotArchiveMixin, BotSearchMixin):
+    def __init__(self, *args, tg_token, api_server: str = TG_API_SERVER, **kwargs):
         super().__init__(*args, **kwargs)
         self._storage = MemoryStorage()
-        self._bot: Bot = Bot(token=tg_token)
+        server = TelegramAPIServer.from_base(api_server) if api_server else TELEGRAM_PRODUCTION
+        self._bot: ScheduledBot = ScheduledBot(token=tg_token, server=server)
         self._dispatcher: Dispatcher = Dispatcher(bot=self._bot, storage=self._storage)
         self.add_msg_handlers(self._dispatcher)
 
     def run(self):
+        asyncio.get_event_loop().run_until_complete(bootstrap())
+        if ARCHIVE_INTERVAL:
+            asyncio.get_event_loop().create_task(run_archiving())
         asyncio.get_event_loop().run_until_complete(self.set_commands(self._bot))
-        executor.start_polling(self._dispatcher, skip_updates=True)
+        if TG_MODE == TG_MODE_WEBHOOK:
+            return self._run_webhook()
+        executor.start_polling(self._dispatcher, skip_updates=True, on_shutdown=self._on_shutdown)
         asyncio.get_event_loop().run_forever()
 
-    async def _send_to_channels(self, channels: List[str], msg: str):
-        return await asyncio.gather(
-            *[self._bot.send_message(chat_id=channel,
-                                     text=msg, disable_notification=False, parse_mode='HTML')
-              for channel in channels])
+    async def start_webhook(self, url: str = TG_WEBHOOK_URL, secret: str = TG_WEBHOOK_SECRET,
+                            **server_kwargs) -> web.AppRunner:
+        runner = await start_webhook_server(self._dispatcher, secret=secret, **server_kwargs)
+        # Pending updates are dropped like the skipped ones of polling
+        await self._bot.set_webhook(url, secret_token=secret, drop_pending_updates=True)
+        return runner
+
+    def _run_webhook(self):
+        loop = asyncio.get_event_loop()
+        runner = loop.run_until_complete(self.start_webhook())
+        try:
+            loop.run_forever()
+        except (KeyboardInterrupt, SystemExit):
+            pass
+        finally:
+            loop.run_until_complete(self._shutdown_webhook(runner))
+
+    async def _shutdown_webhook(self, runner: web.AppRunner):
+        # Webhook stays set, so other replicas and the next start keep receiving updates
+        await runner.cleanup()
+        await self._on_shutdown(self._dispatcher)
+        await self._dispatcher.storage.close()
+        await (await self._bot.get_session()).close()
+
+    async def _on_shutdown(self, _: Dispatcher):
+        # WS server may run in the same process, its buffered messages are written before exit
+        await message_writer.close()
+
+    async def _send_to_channels(self, channels: List[str], msg: str, priority: int = PRIORITY_REPLY,
+                                route: Union[Route, None] = None):
+        async def send(channel: str):
+            sent = await self._bot.send_message(chat_id=channel, text=msg, disable_notification=False,
+                                                parse_mode='HTML', priority=priority)
+            if route:
+                # Replies to the message are routed to the chat without parsing its text, other sends are rate limited
+                # and may take a while, so it is routable right away
+                try:
+                    await add_routes([(sent.chat.id, sent.message_id)], route)
+                except Exception as e:
+                    print(f'Route of {route.token} was not stored: {e!r}')
+            return sent
+
+        results = await asyncio.gather(*[send(channel) for channel in channels], return_exceptions=True)
+        # A chat which blocked the bot does not stop the others from getting the message
+        for channel, result in zip(channels, results):
+            if isinstance(result, Exception):
+                print(f'Message to {channel} failed: {result!r}')
+        return results
 
-    async def send_tg_message(self, token: str, msg: str):
-        subscribers = get_website_subscribers(token)
+    async def send_tg_message(self, token: str, msg: str, route: Union[Route, None] = None):
+        subscribers = await get_website_subscribers(token)
         # return await self._bot.send_message(chat_id=subscribers[0][USER_CHANNEL_KEY], text=msg, disable_notification=True)
         # Send message to all the subscribers
-        return await self._send_to_channels([sub[USER_CHANNEL_KEY] for sub in subscribers], msg)
+        return await self._send_to_channels([sub[USER_CHANNEL_KEY] for sub in subscribers], msg, PRIORITY_NOTIFICATION,
+                                            route)
@@ -1,71 +1,104 @@
+import asyncio
+import os
 import time
+from typing import Dict, List, Tuple
 
-from aiogram import types
-from aiogram.dispatcher import FSMContext
+from aiogram import types, Dispatcher
+from dotenv import load_dotenv
 
 from communication.base import BusDir, BusMessage, CHANNEL_KEY
 from communication.mixins import BusMixin
 from db.messaging import ChatMessage
-from db.website import TOKEN_KEY, get_full_session_key, get_host_from_token, get_token_from_host, is_user_subscribed, \
-    get_website_subscribers
+from db.routing import Route
+from db.website import get_host_from_token, is_user_subscribed, get_website_subscribers, get_session_end
+from helpers.ids import new_message_id
 from telegram.base import TelegramBotMixin
-from telegram.formatter import create_formatted_user_text, REPLY_TXT, get_session_end_from_msg, \
-    create_formatted_reply_text, get_user_from_msg, get_user_txt_from_msg, get_host_from_msg
+from telegram.formatter import create_formatted_user_text, create_formatted_reply_text
+from telegram.handlers import get_reply_route
+
+load_dotenv()
+
+# Visitor messages of a session coming within the delay are sent as one, 0 sends each of them right away. Delayed
+# messages are acknowledged on the bus already, so the ones waiting are lost if the bot crashes
+TG_COALESCE_DELAY_MS = float(os.environ.get('TG_COALESCE_DELAY_MS', 0))
+TG_COALESCE_MAX = int(os.environ.get('TG_COALESCE_MAX', 10))
 
 
 class TelegramBot(BusMixin, TelegramBotMixin):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, sub_dir=BusDir.COM, pub_dir=BusDir.TG, **kwargs)
+        # Session to its messages waiting to be sent and the timer sending them
+        self._coalesced: Dict[str, Tuple[List[ChatMessage], asyncio.TimerHandle]] = {}
+
+    async def _notify(self, messages: List[ChatMessage]):
+        first = messages[0]
+        text = '\n'.join(msg.text for msg in messages)
+        formatted_text = create_formatted_user_text(await get_host_from_token(first.token),
+                                                    first.session[-12:],
+                                                    first.user,
+                                                    text)
+        route = Route(first.token, first.session, first.user, text)
+        return await self.send_tg_message(first.token, formatted_text, route)
+
+    async def _flush_coalesced(self, session: str):
+        if session in self._coalesced:
+            messages, timer = self._coalesced.pop(session)
+            timer.cancel()
+            await self._notify(messages)
+
+    async def _flush_delayed(self, session: str):
+        # Nothing awaits the timer, so failures are reported here
+        try:
+            await self._flush_coalesced(session)
+        except Exception as e:
+            print(f'Coalesced messages of {session[-12:]} were not sent: {e!r}')
 
     async def on_bus_message(self, message: BusMessage):
         await super().on_bus_message(message)
         chat_message: ChatMessage = ChatMessage.from_dict(message.data)
-        formatted_text = create_formatted_user_text(get_host_from_token(chat_message.token),
-                                                    chat_message.session[-12:],
-                                                    chat_message.user,
-                                                    chat_message.text)
-        return await self.send_tg_message(message.data[TOKEN_KEY], formatted_text)
+        if not TG_COALESCE_DELAY_MS:
+            return await self._notify([chat_message])
+        session = chat_message.session
+        if session in self._coalesced and self._coalesced[session][0][0].user != chat_message.user:
+            # Merged messages share one header
+            await self._flush_coalesced(session)
+        if session not in self._coalesced:
+            timer = asyncio.get_event_loop().call_later(
+                TG_COALESCE_DELAY_MS / 1000, lambda: asyncio.ensure_future(self._flush_delayed(session)))
+            self._coalesced[session] = ([], timer)
+        self._coalesced[session][0].append(chat_message)
+        if len(self._coalesced[session][0]) >= TG_COALESCE_MAX:
+            await self._flush_coalesced(session)
+
+    async def _on_shutdown(self, dispatcher: Dispatcher):
+        await asyncio.gather(*[self._flush_coalesced(session) for session in list(self._coalesced)])
+        await super()._on_shutdown(dispatcher)
 
     async def handle_reply(self, message: types.Message):
         try:
-            parent_text = message.reply_to_message.text
-            if REPLY_TXT in parent_text:
+            route = await get_reply_route(message)
+            if not route:
                 return
-            host = get_host_from_msg(parent_text)
-            # token_end = re.search(f'^{TOKEN_TXT}([^\n]+)', parent_text, re.M).group(1)
-            session_key_end = get_session_end_from_msg(parent_text)
-            token = get_token_from_host(host)
             chat = message.from_user.username if message.chat.type == 'private' else message.chat.title
-            if not is_user_subscribed(chat, token):
+            if not await is_user_subscribed(chat, route.token):
                 await message.reply('You are no longer subscribed to this website!')
                 return
-            # token = get_full_token(token_end)
-            session_key = get_full_session_key(token, session_key_end)
-            data = ChatMessage(token=token,
+            data = ChatMessage(token=route.token,
                                text=message.text,
                                timestamp=int(time.time()),
-                               session=session_key,
+                               session=route.session,
                                user=message.from_user.first_name,
-                               username=message.from_user.username)
-            self.send_bus_message(token, data.to_dict())
-            channels = [sub[CHANNEL_KEY] for sub in get_website_subscribers(token)
+                               username=message.from_user.username,
+                               id=new_message_id())
+            await self.send_bus_message(route.token, data.to_dict())
+            channels = [sub[CHANNEL_KEY] for sub in await get_website_subscribers(route.token)
                         if sub[CHANNEL_KEY] != message.chat.id]
-            user = get_user_from_msg(parent_text)
-            user_txt = get_user_txt_from_msg(parent_text)
-
             text_to_others = create_formatted_reply_text(message.from_user.username, message.text,
-                                                         host, session_key_end,
-                                                         user, user_txt)
+                                                         await get_host_from_token(route.token),
+                                                         get_session_end(route.session),
+                                                         route.user, route.text)
             await self._send_to_channels(channels, text_to_others)
         except AttributeError:
             await self._bot.send_message(chat_id=message.chat.id,
                                          text='Message you replied to is incorrect and does not belong to any chat',
                                          disable_notification=False)
-
-    async def handle_add_pass(self, message: types.Message, state: FSMContext):
-        await super().handle_add_pass(message, state)
-        self._update_websites()
-
-    async def handle_remove_pass(self, message: types.Message, state: FSMContext):
-        await super().handle_add_pass(message, state)
-        self._update_websites()
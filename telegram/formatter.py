@@ -1,4 +1,6 @@
 import re
+from html import escape
+from typing import List, Tuple
 
 REPLY_TXT = 'Reply from @'
 HOST_TXT = ''
@@ -6,6 +8,7 @@ TOKEN_TXT = 'WSID: '
 SESSION_TXT = 'ID: '
 USER_TXT = 'User: '
 TEXT_TXT = '\n'
+SEARCH_TXT = 'Search: '
 
 
 def format_host(host: str) -> str:
@@ -41,7 +44,8 @@ def get_user_from_msg(text: str) -> str:
 
 
 def get_user_txt_from_msg(text: str) -> str:
-    return re.search(f'^{USER_TXT}[^\n]+\\s+(.+)', text, re.M).group(1)
+    # Coalesced visitor messages take several lines
+    return re.search(f'^{USER_TXT}[^\n]+\\s+(.+)', text, re.M | re.S).group(1)
 
 
 def create_formatted_user_text(host, session_id, user, text) -> str:
@@ -59,3 +63,11 @@ def create_formatted_reply_text(from_user, from_user_txt,
            f'{format_text(from_user_txt)}\n\nto\n' \
            f'{format_host(host)}\n{format_session(session_key_end)}\n' \
            f'{format_user(to_user)}\n{to_user_txt}'
+
+
+def create_formatted_search_text(query: str, skip: int, results: List[Tuple[str, str, str, str]]) -> str:
+    # Results are host, session end, user and text of found messages
+    lines = [f'{SEARCH_TXT}<b>{escape(query)}</b>, results {skip + 1}-{skip + len(results)}']
+    for host, session_end, user, text in results:
+        lines += ['', format_host(host), format_session(session_end), format_user(escape(user)), escape(text)]
+    return '\n'.join(lines)
@@ -1,11 +1,40 @@
+from typing import Union
+
 from aiogram import types, Dispatcher, Bot
 from aiogram.dispatcher import FSMContext
 from aiogram.dispatcher.filters.state import State, StatesGroup
 
+from db.archive import restore_session, set_retention
+from db.messaging import search_messages
+from db.routing import Route, get_route
 from db.website import HOST_KEY, ALIAS_KEY, PASSWORD_KEY, add_website, TOKEN_KEY, subscribe_website, \
-    unsubscribe_website, remove_website, get_token_from_host, get_full_session_key, ban_session, unban_session
+    unsubscribe_website, remove_website, get_token_from_host, get_full_session_key, ban_session, unban_session, \
+    is_user_subscribed, get_subscribed_tokens, get_host_from_token, get_session_end
+from helpers.cache import TTLCache, MISSING
 from helpers.parsing import extract_host
-from telegram.formatter import REPLY_TXT, get_host_from_msg, get_session_end_from_msg, get_user_from_msg
+from telegram.formatter import REPLY_TXT, get_host_from_msg, get_session_end_from_msg, get_user_from_msg, \
+    get_user_txt_from_msg, create_formatted_search_text
+
+SEARCH_PAGE_SIZE = 5
+# Chat to its last search query and the amount of results shown. Kept apart from the FSM data, which is passed to the
+# website forms as it is
+SEARCH_CURSORS_TTL = 3600
+SEARCH_CURSORS_SIZE = 10000
+_search_cursors = TTLCache(SEARCH_CURSORS_TTL, SEARCH_CURSORS_SIZE)
+
+
+async def get_reply_route(message: types.Message) -> Union[Route, None]:
+    # Chat of a visitor message the given message replies to, None for replies of operators
+    parent = message.reply_to_message
+    route = await get_route(message.chat.id, parent.message_id)
+    if route:
+        return route
+    # Messages sent before they were routed are parsed
+    if REPLY_TXT in parent.text:
+        return None
+    token = await get_token_from_host(get_host_from_msg(parent.text))
+    session_key = await get_full_session_key(token, get_session_end_from_msg(parent.text))
+    return Route(token, session_key, get_user_from_msg(parent.text), get_user_txt_from_msg(parent.text))
 
 
 class BaseBotMixin:
@@ -90,17 +119,12 @@ class BotBanHandleMixin(BaseBotMixin,
     async def handle_ban(self, message: types.Message):
         try:
             if message.reply_to_message:
-                parent_text = message.reply_to_message.text
-                if REPLY_TXT in parent_text:
+                route = await get_reply_route(message)
+                if not route:
                     await message.reply('Select a message reply from user')
                     return
-                host = get_host_from_msg(parent_text)
-                session_key_end = get_session_end_from_msg(parent_text)
-                user = get_user_from_msg(parent_text)
-                token = get_token_from_host(host)
-                session_key = get_full_session_key(token, session_key_end)
-                if ban_session(token, session_key):
-                    await message.reply(f'User {user} was banned!')
+                if await ban_session(route.token, route.session):
+                    await message.reply(f'User {route.user} was banned!')
                 else:
                     await message.reply(f'Session not found')
             else:
@@ -119,17 +143,12 @@ class BotUnbanHandleMixin(BaseBotMixin,
     async def handle_unban(self, message: types.Message):
         try:
             if message.reply_to_message:
-                parent_text = message.reply_to_message.text
-                if REPLY_TXT in parent_text:
+                route = await get_reply_route(message)
+                if not route:
                     await message.reply('Select a message reply from user')
                     return
-                host = get_host_from_msg(parent_text)
-                session_key_end = get_session_end_from_msg(parent_text)
-                user = get_user_from_msg(parent_text)
-                token = get_token_from_host(host)
-                session_key = get_full_session_key(token, session_key_end)
-                if unban_session(token, session_key):
-                    await message.reply(f'User {user} was unbanned!')
+                if await unban_session(route.token, route.session):
+                    await message.reply(f'User {route.user} was unbanned!')
                 else:
                     await message.reply(f'Session not found')
             else:
@@ -143,6 +162,119 @@ class BotBanningMixin(BotBanHandleMixin, BotUnbanHandleMixin):
     pass
 
 
+class BotRestoreHandleMixin(BaseBotMixin,
+                            handler='handle_restore',
+                            commands=['restore'],
+                            description='Restore archived chat by reply',
+                            state=None):
+
+    async def handle_restore(self, message: types.Message):
+        try:
+            if message.reply_to_message:
+                route = await get_reply_route(message)
+                if not route:
+                    await message.reply('Select a message reply from user')
+                    return
+                chat = message.from_user.username if message.chat.type == 'private' else message.chat.title
+                if not await is_user_subscribed(chat, route.token):
+                    await message.reply('You are no longer subscribed to this website!')
+                    return
+                restored = await restore_session(route.token, route.session)
+                if restored:
+                    await message.reply(f'{restored} messages were restored from the archive')
+                else:
+                    await message.reply('Nothing to restore')
+            else:
+                await message.reply('Select a message reply from user')
+        except Exception as e:
+            print(e)
+            await message.reply('Incorrect message selected')
+
+
+class BotRetentionHandleMixin(BaseBotMixin,
+                              handler='handle_retention',
+                              commands=['retention'],
+                              description='Set days to keep chats for by reply, 0 keeps them forever',
+                              state=None):
+
+    async def handle_retention(self, message: types.Message):
+        try:
+            route = await get_reply_route(message) if message.reply_to_message else None
+            if not route:
+                await message.reply('Select a message reply from user and add days, e.g. /retention 30')
+                return
+            try:
+                days = float(message.get_args())
+            except ValueError:
+                days = -1
+            if days < 0:
+                await message.reply('Add days to keep chats for, e.g. /retention 30')
+                return
+            chat = message.from_user.username if message.chat.type == 'private' else message.chat.title
+            if await set_retention(chat, route.token, days):
+                await message.reply(f'Chats are kept for {days:g} days' if days else 'Chats are kept forever')
+            else:
+                await message.reply('Only creator is allowed to change retention of a website')
+        except Exception as e:
+            print(e)
+            await message.reply('Incorrect message selected')
+
+
+class BotArchiveMixin(BotRestoreHandleMixin, BotRetentionHandleMixin):
+    pass
+
+
+async def reply_search_page(message: types.Message, query: str, skip: int) -> bool:
+    tokens = await get_subscribed_tokens(message.chat.id)
+    if not tokens:
+        await message.reply('Subscribe to a website first')
+        return False
+    found = await search_messages(tokens, query, skip, SEARCH_PAGE_SIZE)
+    if not found:
+        await message.reply('Nothing more was found' if skip else 'Nothing was found')
+        return False
+    results = [(await get_host_from_token(msg.token), get_session_end(msg.session), msg.user, msg.text)
+               for msg in found]
+    await message.reply(create_formatted_search_text(query, skip, results), parse_mode='HTML')
+    return True
+
+
+class BotSearchHandleMixin(BaseBotMixin,
+                           handler='handle_search',
+                           commands=['search'],
+                           description='Search chats of subscribed websites',
+                           state=None):
+
+    async def handle_search(self, message: types.Message):
+        query = message.get_args()
+        if not query:
+            await message.reply('Add words to search for, e.g. /search order 1234')
+            return
+        _search_cursors.set(message.chat.id, (query, 0))
+        await reply_search_page(message, query, 0)
+
+
+class BotSearchNextHandleMixin(BaseBotMixin,
+                               handler='handle_search_next',
+                               commands=['search_next'],
+                               description='Show more search results',
+                               state=None):
+
+    async def handle_search_next(self, message: types.Message):
+        cursor = _search_cursors.get(message.chat.id)
+        if cursor is MISSING:
+            await message.reply('Search for something first, e.g. /search order 1234')
+            return
+        query, skip = cursor
+        skip += SEARCH_PAGE_SIZE
+        if await reply_search_page(message, query, skip):
+            _search_cursors.set(message.chat.id, (query, skip))
+
+
+class BotSearchMixin(BotSearchHandleMixin, BotSearchNextHandleMixin):
+    pass
+
+
 class AddWebsiteEntry(BaseBotMixin,
                       handler='handle_add_website',
                       commands=['add_website'],
@@ -189,9 +321,9 @@ class AddPassHandle(BaseBotMixin,
         async with state.proxy() as data:
             data[PASSWORD_KEY] = message.text
             if message.chat.type == 'private':
-                token = add_website(message.chat.username, message.chat.id, **dict(data))
+                token = await add_website(message.chat.username, message.chat.id, **dict(data))
             else:
-                token = add_website(message.chat.title, message.chat.id, **dict(data))
+                token = await add_website(message.chat.title, message.chat.id, **dict(data))
             markup = types.ReplyKeyboardRemove()
             if token:
                 await message.answer(f'Success!🥳\n'
@@ -245,9 +377,9 @@ class RemovePassHandle(BaseBotMixin,
         async with state.proxy() as data:
             data[PASSWORD_KEY] = message.text
             if message.chat.type == 'private':
-                alias = remove_website(message.chat.username, **dict(data))
+                alias = await remove_website(message.chat.username, **dict(data))
             else:
-                alias = remove_website(message.chat.title, **dict(data))
+                alias = await remove_website(message.chat.title, **dict(data))
             markup = types.ReplyKeyboardRemove()
             if alias:
                 await message.answer(f'Success!\n'
@@ -295,9 +427,9 @@ class SubPassHandle(BaseBotMixin,
         async with state.proxy() as data:
             data[PASSWORD_KEY] = message.text
             if message.chat.type == 'private':
-                alias = subscribe_website(message.chat.username, message.chat.id, **dict(data))
+                alias = await subscribe_website(message.chat.username, message.chat.id, **dict(data))
             else:
-                alias = subscribe_website(message.chat.title, message.chat.id, **dict(data))
+                alias = await subscribe_website(message.chat.title, message.chat.id, **dict(data))
             markup = types.ReplyKeyboardRemove()
             if alias:
                 await message.answer(f'Success!\n'
@@ -345,9 +477,9 @@ class UnsubPassHandle(BaseBotMixin,
         async with state.proxy() as data:
             data[PASSWORD_KEY] = message.text
             if message.chat.type == 'private':
-                alias = unsubscribe_website(message.chat.username, **dict(data))
+                alias = await unsubscribe_website(message.chat.username, **dict(data))
             else:
-                alias = unsubscribe_website(message.chat.title, **dict(data))
+                alias = await unsubscribe_website(message.chat.title, **dict(data))
             markup = types.ReplyKeyboardRemove()
             if alias:
                 await message.answer(f'Success!\n'
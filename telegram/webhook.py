@@ -0,0 +1,42 @@
+import hmac
+import os
+
+from aiogram import Dispatcher
+from aiogram.dispatcher.webhook import BOT_DISPATCHER_KEY, WebhookRequestHandler
+from aiohttp import web
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Public HTTPS URL Telegram posts updates to, a proxy in front of the listener terminates TLS
+TG_WEBHOOK_URL = os.environ.get('TG_WEBHOOK_URL', '')
+TG_WEBHOOK_SECRET = os.environ.get('TG_WEBHOOK_SECRET', '')
+TG_WEBHOOK_HOST = os.environ.get('TG_WEBHOOK_HOST', 'localhost')
+TG_WEBHOOK_PORT = int(os.environ.get('TG_WEBHOOK_PORT', 8443))
+TG_WEBHOOK_PATH = os.environ.get('TG_WEBHOOK_PATH', '/telegram')
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class SecretWebhookRequestHandler(WebhookRequestHandler):
+    def validate_ip(self):
+        super().validate_ip()
+        secret = self.request.app['secret']
+        if not secret or not hmac.compare_digest(self.request.headers.get(SECRET_HEADER, ''), secret):
+            raise web.HTTPUnauthorized()
+
+
+async def start_webhook_server(dispatcher: Dispatcher, host: str = TG_WEBHOOK_HOST, port: int = TG_WEBHOOK_PORT,
+                               path: str = TG_WEBHOOK_PATH, secret: str = TG_WEBHOOK_SECRET) -> web.AppRunner:
+    # Anyone could post updates otherwise
+    if not secret:
+        raise ValueError('TG_WEBHOOK_SECRET is required in webhook mode')
+    # Served on the running loop, so the WS server and bus subscriptions of the process keep working
+    app = web.Application()
+    app[BOT_DISPATCHER_KEY] = dispatcher
+    app['secret'] = secret
+    app.router.add_route('*', path, SecretWebhookRequestHandler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
@@ -0,0 +1,80 @@
+import asyncio
+import sys
+from typing import List, Tuple
+
+from aiohttp import web, ClientSession
+
+from telegram.base import TelegramBotMixin
+from telegram.webhook import SECRET_HEADER
+
+# End to end check of the webhook mode against a fake Bot API server, run as `python -m telegram.webhook_check`
+CHECK_HOST = 'localhost'
+CHECK_API_PORT = 18081
+CHECK_WEBHOOK_PORT = 18082
+CHECK_PATH = '/telegram'
+CHECK_TOKEN = '123456:check'
+CHECK_SECRET = 'check-secret'
+CHECK_CHAT_ID = 42
+CHECK_START_TEXT = 'Welcome to Telegram Chat Bot!'
+
+
+async def start_fake_api(calls: List[Tuple[str, dict]]) -> web.AppRunner:
+    # Records Bot API calls and answers them the way Telegram does
+    async def handle(request: web.Request):
+        method = request.match_info['method']
+        data = dict(await request.post())
+        calls.append((method, data))
+        if method == 'sendMessage':
+            return web.json_response({'ok': True, 'result': {
+                'message_id': len(calls), 'date': 0, 'text': data['text'],
+                'chat': {'id': int(data['chat_id']), 'type': 'private'}}})
+        return web.json_response({'ok': True, 'result': True})
+
+    app = web.Application()
+    app.router.add_post('/bot{token}/{method}', handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, CHECK_HOST, CHECK_API_PORT).start()
+    return runner
+
+
+def get_start_update() -> dict:
+    sender = {'id': CHECK_CHAT_ID, 'is_bot': False, 'first_name': 'Check', 'username': 'check'}
+    return {'update_id': 1, 'message': {'message_id': 1, 'date': 0, 'from': sender, 'text': '/start',
+                                        'chat': {'id': CHECK_CHAT_ID, 'type': 'private'},
+                                        'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}]}}
+
+
+async def check_webhook() -> List[str]:
+    calls: List[Tuple[str, dict]] = []
+    failures = []
+    api = await start_fake_api(calls)
+    bot = TelegramBotMixin(tg_token=CHECK_TOKEN, api_server=f'http://{CHECK_HOST}:{CHECK_API_PORT}')
+    url = f'http://{CHECK_HOST}:{CHECK_WEBHOOK_PORT}{CHECK_PATH}'
+    runner = await bot.start_webhook(url, CHECK_SECRET, host=CHECK_HOST, port=CHECK_WEBHOOK_PORT, path=CHECK_PATH)
+    try:
+        if ('setWebhook', {'url': url, 'secret_token': CHECK_SECRET, 'drop_pending_updates': 'True'}) not in calls:
+            failures.append('webhook was not set with its secret')
+        async with ClientSession() as session:
+            for headers, expected in (({}, 401), ({SECRET_HEADER: 'wrong'}, 401), ({SECRET_HEADER: CHECK_SECRET}, 200)):
+                async with session.post(url, json=get_start_update(), headers=headers) as response:
+                    if response.status != expected:
+                        failures.append(f'update with headers {headers} got {response.status} instead of {expected}')
+        # Answers go through the send scheduler
+        await asyncio.sleep(0.5)
+        answers = [data for method, data in calls if method == 'sendMessage']
+        if answers != [{'chat_id': str(CHECK_CHAT_ID), 'text': CHECK_START_TEXT}]:
+            failures.append(f'/start was answered with {answers}')
+    finally:
+        await runner.cleanup()
+        await (await bot._bot.get_session()).close()
+        await api.cleanup()
+    return failures
+
+
+if __name__ == '__main__':
+    found = asyncio.get_event_loop().run_until_complete(check_webhook())
+    for failure in found:
+        print(f'Webhook check failed: {failure}')
+    print('Webhook check passed' if not found else f'{len(found)} webhook checks failed')
+    sys.exit(1 if found else 0)
@@ -1,18 +1,34 @@
 import asyncio
 import json
-from typing import Dict
+import os
+import socket
+from typing import Dict, Set, Tuple
 
+from dotenv import load_dotenv
 from websockets import serve
 from websockets.exceptions import ConnectionClosedOK, ConnectionClosedError
 from websockets.legacy.server import WebSocketServerProtocol
 
 from communication.base import BusDir, BusMessage
-from communication.mixins import BusMixin
-from db.messaging import ChatMessage, add_message, get_messages
-from db.website import TOKEN_KEY, create_session_website, validate_website_session, is_session_banned
+from communication.mixins import BusMixin, BAN_EVENT, add_bus_event_handler
+from db.messaging import ChatMessage, ID_KEY, get_messages, message_writer
+from db.schema import bootstrap
+from db.website import TOKEN_KEY, BANNED_KEY, create_session_website, validate_website_session, get_banned_sessions, \
+    set_session_node, unset_session_node, unset_node_sessions, claim_left_reply
+from helpers.ids import new_message_id
+
+load_dotenv()
+
+# Stable name of this node, sessions it held are released when it starts again
+WS_NODE = os.environ.get('WS_NODE', socket.gethostname())
 
 SESSION_KEY = 'session'
 HISTORY_KEY = 'history'
+HISTORY_BEFORE_KEY = 'before'
+HISTORY_AMOUNT_KEY = 'amount'
+# Messages sent on connection and the most a widget may request at once when scrolling back
+HISTORY_AMOUNT = 10
+HISTORY_MAX_AMOUNT = 100
 
 
 class WebsocketServer(BusMixin):
@@ -22,6 +38,9 @@ class WebsocketServer(BusMixin):
         self.port = port
         self.is_standalone = is_standalone
         self._connections: Dict[str, WebSocketServerProtocol] = {}
+        # Token and session pairs, loaded at start and kept up to date by ban events
+        self._banned: Set[Tuple[str, str]] = set()
+        add_bus_event_handler(BAN_EVENT, self._on_ban_event)
 
     @staticmethod
     def _decode_msg(msg: str) -> dict:
@@ -36,59 +55,90 @@ class WebsocketServer(BusMixin):
             await websocket.close()
             return False
         host = websocket.origin
-        if not self.verify_bus_sender(host, message[TOKEN_KEY]):
+        if not await self.verify_bus_sender(host, message[TOKEN_KEY]):
             await websocket.send('Token or host is incorrect')
             await websocket.close()
             return False
-        if is_session_banned(message[TOKEN_KEY], message[SESSION_KEY]):
+        if (message[TOKEN_KEY], message.get(SESSION_KEY)) in self._banned:
             await websocket.send('User is banned')
             await websocket.close()
             return False
         return True
 
     @staticmethod
-    def _request_session_key(token: str) -> str:
-        return create_session_website(token)
+    async def _request_session_key(token: str) -> str:
+        return await create_session_website(token)
 
     @staticmethod
-    def _request_history(token: str, session_key: str) -> list:
-        messages = get_messages(token, session_key)
+    async def _request_history(token: str, session_key: str, before: int = 0, amount: int = HISTORY_AMOUNT) -> list:
+        messages = await get_messages(token, session_key, amount=amount, before=before)
         return [msg.to_dict() for msg in messages]
 
+    async def _send_history(self, websocket: WebSocketServerProtocol, token: str, session_key: str, request: dict):
+        # Request is {"before": <id of the oldest message the widget has>, "amount": <messages>}
+        try:
+            before = int(request.get(HISTORY_BEFORE_KEY, 0))
+            amount = min(max(int(request.get(HISTORY_AMOUNT_KEY, HISTORY_AMOUNT)), 1), HISTORY_MAX_AMOUNT)
+        except (AttributeError, TypeError, ValueError):
+            await websocket.send('Incorrect history request')
+            return
+        history = await self._request_history(token, session_key, before, amount)
+        await websocket.send(json.dumps({HISTORY_KEY: history}))
+
+    async def _load_banned(self):
+        self._banned |= {(session[TOKEN_KEY], session[SESSION_KEY]) for session in await get_banned_sessions()}
+
+    async def _on_ban_event(self, data: dict):
+        key = (data[TOKEN_KEY], data[SESSION_KEY])
+        if not data[BANNED_KEY]:
+            self._banned.discard(key)
+            return
+        self._banned.add(key)
+        websocket = self._connections.get(data[SESSION_KEY])
+        if websocket:
+            await websocket.send('User is banned')
+            await websocket.close()
+
     async def on_bus_message(self, message: BusMessage):
         await super().on_bus_message(message)
         chat_message = ChatMessage(**message.data)
-        add_message(chat_message)
+        stored = await message_writer.store(chat_message)
         if message.data[SESSION_KEY] in self._connections:
-            await self._connections[message.data[SESSION_KEY]].send(chat_message.to_json())
-        else:
+            if stored:
+                await self._connections[message.data[SESSION_KEY]].send(chat_message.to_json())
+            else:
+                # Visitors see only replies kept in their history, the operator may send it again
+                reply_message = {**chat_message.to_dict(), 'text': 'Reply was not stored and not delivered'}
+                await self.send_bus_message(chat_message.token, reply_message)
+        elif await claim_left_reply(chat_message.token, chat_message.session, chat_message.id):
             reply_message = {**chat_message.to_dict(), 'text': 'User has already left'}
-            self.send_bus_message(chat_message.token, reply_message)
+            await self.send_bus_message(chat_message.token, reply_message)
 
-    async def _session_established(self, websocket: WebSocketServerProtocol) -> str:
+    async def _session_established(self, websocket: WebSocketServerProtocol) -> Tuple[str, str]:
         message = self._decode_msg(await websocket.recv())
         if not await self._verify_msg(websocket, message):
-            return ''
+            return '', ''
 
         if SESSION_KEY in message and message[SESSION_KEY] and \
-                validate_website_session(message[TOKEN_KEY], message[SESSION_KEY]):
+                await validate_website_session(message[TOKEN_KEY], message[SESSION_KEY]):
             session_key = message[SESSION_KEY]
         else:
-            session_key = self._request_session_key(message[TOKEN_KEY])
+            session_key = await self._request_session_key(message[TOKEN_KEY])
             if not session_key:
                 await websocket.send('Internal error')
                 await websocket.close()
-                return ''
+                return '', ''
             await websocket.send(json.dumps({SESSION_KEY: session_key}))
-        history = self._request_history(message[TOKEN_KEY], session_key)
+        history = await self._request_history(message[TOKEN_KEY], session_key)
         await websocket.send(json.dumps({HISTORY_KEY: history}))
         self._connections[session_key] = websocket
-        return session_key
+        await set_session_node(message[TOKEN_KEY], session_key, WS_NODE)
+        return message[TOKEN_KEY], session_key
 
     async def _worker(self, websocket: WebSocketServerProtocol):
-        session_key = ''
+        token, session_key = '', ''
         try:
-            session_key = await self._session_established(websocket)
+            token, session_key = await self._session_established(websocket)
             if not session_key:
                 return
 
@@ -96,16 +146,41 @@ class WebsocketServer(BusMixin):
                 message = self._decode_msg(await websocket.recv())
                 if not await self._verify_msg(websocket, message):
                     return
-                chat_message = ChatMessage.from_dict(message)
-                add_message(chat_message)
-                self.send_bus_message(chat_message.token, chat_message.to_dict())
+                if HISTORY_KEY in message:
+                    await self._send_history(websocket, message[TOKEN_KEY], session_key, message[HISTORY_KEY])
+                    continue
+                if message.get(SESSION_KEY) != session_key:
+                    await websocket.send('Session is incorrect')
+                    await websocket.close()
+                    return
+                # Messages are identified on entry, whatever the widget sent
+                chat_message = ChatMessage.from_dict({**message, ID_KEY: new_message_id()})
+                if not await message_writer.store(chat_message):
+                    # Not forwarded either, so operators never answer a message missing from the history
+                    await websocket.send('Message was not stored')
+                    continue
+                await self.send_bus_message(chat_message.token, chat_message.to_dict())
                 print(chat_message)
         except (ConnectionClosedOK, ConnectionClosedError):
-            if session_key:
+            pass
+        finally:
+            # Sockets closed by the server after a failed check are released too
+            if session_key and self._connections.get(session_key) is websocket:
                 del self._connections[session_key]
+                await unset_session_node(token, session_key, WS_NODE)
 
     def start(self):
+        asyncio.get_event_loop().run_until_complete(bootstrap())
+        asyncio.get_event_loop().run_until_complete(self._load_banned())
+        asyncio.get_event_loop().run_until_complete(unset_node_sessions(WS_NODE))
         server = serve(lambda websocket: self._worker(websocket), self.host, self.port)
         asyncio.get_event_loop().run_until_complete(server)
         if self.is_standalone:
-            asyncio.get_event_loop().run_forever()
+            try:
+                asyncio.get_event_loop().run_forever()
+            finally:
+                asyncio.get_event_loop().run_until_complete(self.close())
+
+    async def close(self):
+        # Messages still buffered for writing are not lost on shutdown
+        await message_writer.close()